@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+   Benchmarks for the hot paths of openvpn_management, run against the
+   simulated management server (test/fakeserver.py) in a child process,
+   so that the numbers are the client's alone.
+
+   For each client count and status format it times fetching and parsing
+   the status (wall and CPU time, best of --repeat runs), then does one
+   more run under tracemalloc for peak memory and allocated blocks.  It
+   also measures kills per second, serial and batched, and the round
+   trip latency of a trivial command.  Results go out as JSON.
+
+       python bench/bench_vpnmgmt.py --sizes 1000,10000 --output bench.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.dont_write_bytecode = True
+# pylint: disable=wrong-import-position
+from test.fakeserver import FakeManagementServer  # noqa: E402
+from openvpn_management import VPNmgmt  # noqa: E402
+
+
+SOCKET_PATH = '/tmp/openvpn-management-bench'  # nosec hardcoded_tmp_directory
+
+
+def _serve(path, clients, ready):
+    '''
+        Child process: run a fake server until killed.
+    '''
+    server = FakeManagementServer(path, clients=clients)
+    # Render every format up front, so the client isn't timing the server.
+    for version in (1, 2, 3):
+        server.status(version)
+    server.start()
+    ready.set()
+    while True:
+        time.sleep(3600)
+
+
+class Server(object):
+    '''
+        A fake server with a given number of clients, in a child process.
+    '''
+    def __init__(self, clients):
+        self.clients = clients
+        self.process = None
+
+    def __enter__(self):
+        ready = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=_serve, args=(SOCKET_PATH, self.clients, ready))
+        self.process.daemon = True
+        self.process.start()
+        if not ready.wait(120):
+            raise RuntimeError('fake server did not start')
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.join()
+        if os.path.exists(SOCKET_PATH):
+            os.unlink(SOCKET_PATH)
+
+
+def _connect():
+    ''' A connected client '''
+    client = VPNmgmt(SOCKET_PATH)
+    client.connect()
+    return client
+
+
+def measure(func, repeat):
+    '''
+        Run func() repeat times for the best wall and CPU time, then once
+        more under tracemalloc for peak memory and net allocated blocks.
+    '''
+    walls = []
+    cpus = []
+    for _count in range(repeat):
+        wall, cpu = time.perf_counter(), time.process_time()
+        func()
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = func()
+    after = tracemalloc.take_snapshot()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    del result
+    return {'wall_s': min(walls), 'cpu_s': min(cpus), 'peak_bytes': peak, 'net_blocks': blocks}
+
+
+def bench_status(sizes, repeat):
+    '''
+        Fetch-and-parse cost of each status format, and of getusers.
+    '''
+    results = []
+    for size in sizes:
+        with Server(size):
+            client = _connect()
+            for version in (1, 2, 3):
+                stats = measure(lambda v=version: list(client.iter_status(v)), repeat)
+                results.append(dict(stats, benchmark='iter_status', clients=size, status_version=version))
+            stats = measure(lambda: client.status(), repeat)  # pylint: disable=unnecessary-lambda
+            results.append(dict(stats, benchmark='status_text', clients=size, status_version=2))
+            stats = measure(client.getusers, repeat)
+            results.append(dict(stats, benchmark='getusers', clients=size, status_version=2))
+            client.disconnect()
+    return results
+
+
+def bench_kills(count):
+    '''
+        Kills per second, one at a time and as one batch.
+    '''
+    results = []
+    with Server(count * 2):
+        client = _connect()
+        users = [f'user{cid}@company.com' for cid in range(count)]
+        start = time.perf_counter()
+        for user in users:
+            client.kill(user, commit=True)
+        elapsed = time.perf_counter() - start
+        results.append({'benchmark': 'kill', 'kills': count, 'wall_s': elapsed,
+                        'kills_per_s': count / elapsed})
+        users = [f'user{cid}@company.com' for cid in range(count, count * 2)]
+        start = time.perf_counter()
+        client.kill_many(users, commit=True)
+        elapsed = time.perf_counter() - start
+        results.append({'benchmark': 'kill_many', 'kills': count, 'wall_s': elapsed,
+                        'kills_per_s': count / elapsed})
+        client.disconnect()
+    return results
+
+
+def bench_latency(count):
+    '''
+        Round trip latency of a trivial command ('pid').
+    '''
+    with Server(0):
+        client = _connect()
+        samples = []
+        for _count in range(count):
+            start = time.perf_counter()
+            client._send('pid')  # pylint: disable=protected-access
+            samples.append(time.perf_counter() - start)
+        client.disconnect()
+    samples.sort()
+
+    def percentile(fraction):
+        ''' The given fraction's sample '''
+        return samples[min(int(fraction * len(samples)), len(samples) - 1)]
+    return [{'benchmark': 'round_trip', 'command': 'pid', 'samples': count,
+             'p50_s': percentile(0.50), 'p90_s': percentile(0.90),
+             'p99_s': percentile(0.99), 'max_s': samples[-1]}]
+
+
+def main(argv=None):
+    ''' Run the benchmarks and write the JSON report '''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma-separated client counts (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='timing runs per case')
+    parser.add_argument('--kills', type=int, default=2000, help='users to kill per kill benchmark')
+    parser.add_argument('--pings', type=int, default=2000, help='commands for the latency benchmark')
+    parser.add_argument('--output', default='-', help='file for the JSON report (default: stdout)')
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': int(time.time()),
+        'results': (bench_status(sizes, args.repeat) + bench_kills(args.kills) +
+                    bench_latency(args.pings)),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
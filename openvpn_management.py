@@ -4,173 +4,3442 @@
 
 """
 
+import array
+import bisect
+import collections
+import heapq
+import importlib
+import itertools
+import mmap
+import queue
 import socket
 import select
 import sys
+import threading
+import time
 import os
-import re
 sys.dont_write_bytecode = True
 
 
+class _LazyModule(object):
+    """
+        Stands in for a module until it is first used, then imports it
+        and puts it in its place.  Only the asyncio, thread-safe and
+        pool clients need asyncio and concurrent.futures, and importing
+        those takes longer than a whole run of the command line tool.
+    """
+    def __init__(self, name, binding=None):
+        self._name = name
+        self._binding = binding or name
+
+    def __getattr__(self, attr):
+        importlib.import_module(self._name)
+        module = sys.modules[self._binding]
+        globals()[self._binding] = module
+        return getattr(module, attr)
+
+
+asyncio = _LazyModule('asyncio')
+concurrent = _LazyModule('concurrent.futures', 'concurrent')
+
+
+# How the reply to a management command is framed on the wire.
+FRAME_NONE = 0          # no reply at all: quit, exit
+FRAME_LINE = 1          # one SUCCESS: or ERROR: line
+FRAME_END = 2           # lines up to a lone END, or a single ERROR: line
+FRAME_SUCCESS_END = 3   # a SUCCESS: line, then lines up to END ('log on all')
+
+# Commands whose reply is a multi-line block closed by END.
+_END_COMMANDS = frozenset(['status', 'version', 'help', 'net'])
+# Commands that take on/off/all/N and only give a block for all/N.
+_HISTORY_COMMANDS = frozenset(['log', 'state', 'echo'])
+
+
+def _quote(text):
+    """
+        Quote text as one argument of a management command.  Line breaks
+        would end the command, so they become spaces.
+    """
+    text = ' '.join(str(text).splitlines())
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+# What openvpn says, without a line ending, when it wants a password.
+_PASSWORD_PROMPT = b'ENTER PASSWORD:'
+
+
+def _management_address(socket_path):
+    """
+        Where a management interface listens, from how it was given to
+        us: the absolute path of a unix socket, or host:port for a TCP
+        one ('management 127.0.0.1 7505'), with an IPv6 address in
+        brackets ([::1]:7505).  Returns (address family, address).
+    """
+    if os.path.isabs(socket_path):
+        return socket.AF_UNIX, socket_path
+    host, _sep, port = socket_path.rpartition(':')
+    if host and port.isdigit():
+        if host.startswith('[') and host.endswith(']'):
+            return socket.AF_INET6, (host[1:-1], int(port))
+        return socket.AF_INET, (host, int(port))
+    raise ValueError('management sockets are absolute unix socket paths or host:port')
+
+
+def _tune_tcp(sock):
+    """
+        Set up a TCP socket for a management connection.  Commands and
+        replies are small and each waits on the other, so Nagle would
+        only add delay; keepalives let the kernel notice a peer that
+        vanished off the network while we sat quiet.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+
+class ManagementTimeout(socket.timeout):
+    """
+        A call ran past its timeout.  partial holds what had arrived of
+        the reply (bytes).  The connection has been reset, since the
+        rest of that reply would otherwise be taken for the answer to
+        the next command: connect() again to carry on.  When several
+        commands went out together (kill_many), replies has the ones
+        that were complete.
+    """
+    def __init__(self, message, partial=b'', replies=()):
+        super().__init__(message)
+        self.partial = partial
+        self.replies = list(replies)
+
+
+def _deadline(timeout):
+    """
+        The time.monotonic() by which something given timeout seconds
+        must be done, or None for no limit.
+    """
+    if timeout is None:
+        return None
+    return time.monotonic() + timeout
+
+
+def _remaining(deadline):
+    """
+        Seconds left until deadline (None: no limit), never negative.
+    """
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0.0)
+
+
+def reply_framing(command):
+    """
+        Work out how the server will frame its reply to command, so
+        that we can stop reading the moment the reply is complete
+        instead of waiting for the server to go quiet.
+        https://openvpn.net/community-resources/management-interface/
+    """
+    words = command.split()
+    if not words:
+        return FRAME_LINE
+    verb = words[0].lower()
+    if verb in ('quit', 'exit'):
+        return FRAME_NONE
+    if verb in _END_COMMANDS:
+        return FRAME_END
+    if verb == 'state' and len(words) == 1:
+        # A bare 'state' is 'state 1': the current state, then END.
+        return FRAME_END
+    if verb in _HISTORY_COMMANDS and len(words) > 1:
+        args = [arg.lower() for arg in words[1:]]
+        if args[0] in ('on', 'off'):
+            if len(args) > 1:
+                # 'log on all': acknowledge, then dump the history.
+                return FRAME_SUCCESS_END
+            return FRAME_LINE
+        return FRAME_END
+    return FRAME_LINE
+
+
+def _reply_done(framing, index, buf, start, end):
+    """
+        Given that buf[start:end] is line number index (from 0) of a
+        reply framed as framing, say if that line completes the reply.
+        Works on the line in place, without copying it out of buf.
+    """
+    if framing == FRAME_LINE:
+        return True
+    if index == 0:
+        if buf.startswith(b'ERROR:', start, end):
+            return True
+        if framing == FRAME_SUCCESS_END:
+            return False
+    # A lone END.  Lines that merely contain END (CLIENT_LIST,END,...)
+    # are longer than 'END\r\n' and so can't match.
+    return end - start <= 5 and buf.startswith(b'END', start, end)
+
+
+class ResponseReader(object):
+    """
+        Buffered reader for the openvpn management socket.
+
+        Data is pulled off the socket with recv_into into one preallocated
+        chunk and appended to a bytearray.  Only bytes that arrived since
+        the last look are ever scanned, and a reply is cut off the front of
+        the buffer in a single copy, so reading a multi-megabyte status is
+        linear in its size rather than quadratic.
+    """
+    def __init__(self, sock, chunk_size=65536):
+        """
+            Wrap an already-created socket.  chunk_size is how much we
+            ask the kernel for in any one recv.
+        """
+        self.sock = sock
+        self.buffer = bytearray()
+        self._chunk = memoryview(bytearray(chunk_size))
+        # Offset in buffer up to which we have already looked.
+        self._scanned = 0
+        self.eof = False
+        # Running totals, for Metrics: bytes and recv calls it took to
+        # get them, and seconds spent waiting on the socket.
+        self.bytes_received = 0
+        self.recv_calls = 0
+        self.wait_seconds = 0.0
+        # Called with each '>' notification line (without its line
+        # ending) that turns up, in or out of a reply.  None drops them.
+        self.notify = None
+
+    def fill(self, timeout):
+        """
+            Wait up to timeout seconds for the socket to be readable and
+            append whatever arrives to the buffer.  Returns the number of
+            bytes read: 0 means we timed out or the peer closed (eof).
+        """
+        start = time.perf_counter()
+        rbuf, _wbuf, _ebuf = select.select([self.sock], [], [], timeout)
+        if not rbuf:
+            self.wait_seconds += time.perf_counter() - start
+            return 0
+        nbytes = self.sock.recv_into(self._chunk)
+        self.wait_seconds += time.perf_counter() - start
+        self.recv_calls += 1
+        if nbytes == 0:
+            self.eof = True
+        else:
+            self.bytes_received += nbytes
+            self.buffer += self._chunk[:nbytes]
+        return nbytes
+
+    def _take(self, length):
+        """
+            Remove and return the first length bytes of the buffer.
+            Deleting from the front of a bytearray is cheap in CPython.
+        """
+        data = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        self._scanned = max(self._scanned - length, 0)
+        return data
+
+    def _next_line_end(self, timeout, deadline=None):
+        """
+            Return the offset just past the next newline in the buffer,
+            reading from the socket as needed.  Returns None if the socket
+            went quiet or closed before a full line showed up, or the
+            deadline (a time.monotonic() value) passed.
+        """
+        while True:
+            idx = self.buffer.find(b'\n', self._scanned)
+            if idx != -1:
+                self._scanned = idx + 1
+                return self._scanned
+            self._scanned = len(self.buffer)
+            wait = timeout
+            if deadline is not None:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    return None
+                if timeout is not None:
+                    wait = min(wait, timeout)
+            if self.eof or not self.fill(wait):
+                return None
+
+    def _expired(self, deadline):
+        """
+            Whether we stopped reading because the deadline passed (as
+            opposed to the server going quiet or closing).
+        """
+        return deadline is not None and not self.eof and time.monotonic() >= deadline
+
+    def _timed_out(self, deadline):
+        """
+            The ManagementTimeout for a reply cut short, by its deadline
+            or by the server going quiet in the middle of it, carrying
+            (and clearing out) what we had of it.
+        """
+        if self._expired(deadline):
+            message = 'reply not complete by the deadline'
+        else:
+            message = 'management server went quiet in the middle of a reply'
+        return ManagementTimeout(message, self._take(len(self.buffer)))
+
+    def take_prompt(self, prompt, deadline=None):
+        """
+            Wait for the first bytes from the server, and if they are
+            prompt (a line-ending-less string like 'ENTER PASSWORD:'),
+            remove it and return True.  The prompt may come in pieces;
+            we read until it is complete or plainly isn't coming.
+        """
+        while (len(self.buffer) < len(prompt) and prompt.startswith(bytes(self.buffer))
+               and not self.eof):
+            if not self.fill(_remaining(deadline)):
+                break
+        if self.buffer.startswith(prompt):
+            self._take(len(prompt))
+            return True
+        return False
+
+    def skip_banner(self, deadline=None, grace=0.25):
+        """
+            Wait for the welcome banner and drop it, up to its newline,
+            however many reads it comes in.  A server that leaves off
+            the newline has the banner taken to end once it has been
+            quiet for grace seconds.  Anything after the banner stays in
+            the buffer.  Returns False if nothing arrived by deadline.
+        """
+        if not self.buffer and not self.fill(_remaining(deadline)) and not self.eof:
+            return False
+        end = self._next_line_end(grace, deadline)
+        self._take(end or len(self.buffer))
+        return True
+
+    def read_reply(self, framing=FRAME_END, timeout=None, deadline=None):
+        """
+            Read one reply, framed as framing (see reply_framing), and
+            return it as soon as the line that completes it arrives.
+            timeout is how long the server may stay silent (None means
+            wait as long as it takes).  If it closes, return whatever we
+            have.  If it goes quiet for that long, or the reply isn't
+            complete by deadline, raise ManagementTimeout: a reply we
+            know to be unfinished must not pass for a whole one.
+        """
+        if framing == FRAME_NONE:
+            return b''
+        start = 0
+        index = 0
+        while True:
+            end = self._next_line_end(timeout, deadline)
+            if end is None:
+                if not self.eof:
+                    raise self._timed_out(deadline)
+                return self._take(len(self.buffer))
+            if self.buffer.startswith(b'>', start, end):
+                self._divert(start, end)
+                continue
+            if _reply_done(framing, index, self.buffer, start, end):
+                return self._take(end)
+            start = end
+            index += 1
+
+    def _take_line(self, end, start=0):
+        """
+            Remove the line buffer[start:end] from the buffer and return
+            it without its line ending.
+        """
+        stop = end
+        while stop > start and self.buffer[stop - 1] in (0x0a, 0x0d):
+            stop -= 1
+        line = bytes(self.buffer[start:stop])
+        del self.buffer[start:end]
+        self._scanned = max(self._scanned - (end - start), start)
+        return line
+
+    def _divert(self, start, end):
+        """
+            Cut the notification line buffer[start:end] out of the buffer
+            (it is not part of any reply) and pass it to notify.
+        """
+        line = self._take_line(end, start)
+        if self.notify is not None:
+            self.notify(line)
+
+    def iter_reply(self, framing=FRAME_END, timeout=None, deadline=None):
+        """
+            Like read_reply, but yield the reply one line at a time (as
+            bytes, without line endings) as the lines arrive, so that a
+            big reply never has to sit in memory whole.  If the caller
+            stops early, the rest of the reply is read and thrown away
+            so that it can't be mistaken for the next one.
+        """
+        done = framing == FRAME_NONE
+        index = 0
+        try:
+            while not done:
+                end = self._next_line_end(timeout, deadline)
+                if end is None:
+                    # Quiet or past the deadline: the reply is unfinished.
+                    # Closed: hand over any partial last line.
+                    done = True
+                    if not self.eof:
+                        raise self._timed_out(deadline)
+                    if self.buffer:
+                        yield self._take_line(len(self.buffer))
+                    return
+                if self.buffer.startswith(b'>', 0, end):
+                    self._divert(0, end)
+                    continue
+                done = _reply_done(framing, index, self.buffer, 0, end)
+                index += 1
+                yield self._take_line(end)
+        finally:
+            while not done:
+                end = self._next_line_end(timeout, deadline)
+                if end is None:
+                    if not self.eof:
+                        raise self._timed_out(deadline)
+                    self._take(len(self.buffer))
+                    break
+                if self.buffer.startswith(b'>', 0, end):
+                    self._divert(0, end)
+                    continue
+                done = _reply_done(framing, index, self.buffer, 0, end)
+                index += 1
+                self._take(end)
+
+    def read_notifications(self, timeout=None):
+        """
+            For use when no reply is expected: wait up to timeout for a
+            line to arrive, then pass every complete '>' line we have to
+            notify.  Anything else is a stray that nobody is waiting
+            for, and is dropped.  Returns False once the server closed.
+        """
+        end = self._next_line_end(timeout)
+        while end is not None:
+            if self.buffer.startswith(b'>', 0, end):
+                self._divert(0, end)
+            else:
+                self._take(end)
+            end = self.buffer.find(b'\n') + 1 or None
+        return not self.eof
+
+
+# >CLIENT: notifications that are followed by a >CLIENT:ENV block.
+_CLIENT_ENV_EVENTS = frozenset(['CONNECT', 'REAUTH', 'ESTABLISHED', 'DISCONNECT', 'CR_RESPONSE'])
+# How many times to split each kind of notification's text on commas;
+# free-text notifications are not split at all.
+_NOTIFICATION_SPLITS = {'LOG': 2, 'ECHO': 1, 'INFO': 0, 'FATAL': 0, 'HOLD': 0,
+                        'PASSWORD': 0, 'NEED-OK': 0, 'NEED-STR': 0}
+
+
+class Event(object):
+    """
+        One real-time notification from the server.  kind is the part
+        after the '>' ('BYTECOUNT_CLI', 'STATE', 'LOG', ...), or for
+        client notifications 'CLIENT:CONNECT', 'CLIENT:DISCONNECT' and
+        so on.  args are its comma-separated fields, and env holds the
+        name=value pairs of a >CLIENT:ENV block, where there is one.
+    """
+    __slots__ = ('kind', 'args', 'env')
+
+    def __init__(self, kind, args, env=None):
+        self.kind = kind
+        self.args = args
+        self.env = env
+
+    @property
+    def client_id(self):
+        """
+            The client id (cid) a client or bytecount notification is
+            about, or None.
+        """
+        if self.args and (self.kind.startswith('CLIENT:') or self.kind == 'BYTECOUNT_CLI'):
+            try:
+                return int(self.args[0])
+            except ValueError:
+                return None
+        return None
+
+    def __repr__(self):
+        return f'Event({self.kind!r}, {self.args!r}, {self.env!r})'
+
+
+class EventParser(object):
+    """
+        Turns '>' notification lines into Events.  Most are one line,
+        but >CLIENT:CONNECT and friends are followed by >CLIENT:ENV
+        lines, so those are held until their >CLIENT:ENV,END arrives.
+    """
+    def __init__(self):
+        self._pending = None
+
+    def feed(self, line):
+        """
+            Take one notification line (bytes or str, with or without
+            its '>' and line ending).  Returns an Event when one is
+            complete, else None.
+        """
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        line = line.rstrip('\r\n')
+        if line.startswith('>'):
+            line = line[1:]
+        source, _sep, rest = line.partition(':')
+        if source == 'CLIENT':
+            kind, _sep, rest = rest.partition(',')
+            if kind == 'ENV':
+                event = self._pending
+                if event is not None:
+                    if rest == 'END':
+                        self._pending = None
+                        return event
+                    name, _sep, value = rest.partition('=')
+                    event.env[name] = value
+                return None
+            event = Event(f'CLIENT:{kind}', rest.split(',') if rest else [])
+            if kind in _CLIENT_ENV_EVENTS:
+                event.env = {}
+                self._pending = event
+                return None
+            return event
+        maxsplit = _NOTIFICATION_SPLITS.get(source, -1)
+        return Event(source, rest.split(',', maxsplit) if maxsplit else [rest])
+
+
+class _Record(object):
+    """
+        Base for the compact status row types.  Rows are built from the
+        text columns once: counters and time_t columns become ints, and
+        empty or missing columns become None.
+    """
+    __slots__ = ()
+    _fields = ()
+    _ints = frozenset()
+
+    def __init__(self, *args, **kwargs):
+        values = dict(zip(self._fields, args), **kwargs)
+        for field in self._fields:
+            setattr(self, field, values.get(field))
+
+    @classmethod
+    def _make(cls, columns):
+        """
+            Build a record from a list of column strings, in _fields
+            order.  Columns this server version doesn't send may be short.
+        """
+        record = cls.__new__(cls)
+        columns = list(columns)
+        columns += [None] * (len(cls._fields) - len(columns))
+        for field, value in zip(cls._fields, columns):
+            if value == '':
+                value = None
+            elif value is not None and field in cls._ints:
+                try:
+                    value = int(value)
+                except ValueError:
+                    value = None
+            setattr(record, field, value)
+        return record
+
+    def _asdict(self):
+        """
+            Return the record as a dict of field: value.
+        """
+        return {field: getattr(self, field) for field in self._fields}
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, field) == getattr(other, field) for field in self._fields)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, field) for field in self._fields))
+
+    def __repr__(self):
+        values = ', '.join(f'{field}={getattr(self, field)!r}' for field in self._fields)
+        return f'{type(self).__name__}({values})'
+
+
+class Client(_Record):
+    """
+        One row of the CLIENT_LIST table (status 1 only fills in some
+        of these).
+    """
+    _fields = ('common_name', 'real_address', 'virtual_address', 'virtual_ipv6_address',
+               'bytes_received', 'bytes_sent', 'connected_since', 'connected_since_t',
+               'username', 'client_id', 'peer_id', 'cipher')
+    _ints = frozenset(['bytes_received', 'bytes_sent', 'connected_since_t',
+                       'client_id', 'peer_id'])
+    __slots__ = _fields
+
+
+class Route(_Record):
+    """
+        One row of the ROUTING_TABLE table.
+    """
+    _fields = ('virtual_address', 'common_name', 'real_address', 'last_ref', 'last_ref_t')
+    _ints = frozenset(['last_ref_t'])
+    __slots__ = _fields
+
+
+class LoadStats(_Record):
+    """
+        The server's 'load-stats' summary: clients connected, and bytes
+        in and out over the whole server.
+    """
+    _fields = ('nclients', 'bytesin', 'bytesout')
+    _ints = frozenset(_fields)
+    __slots__ = _fields
+
+
+def parse_load_stats(reply):
+    """
+        Turn a 'load-stats' reply
+            SUCCESS: nclients=1,bytesin=2,bytesout=3
+        into LoadStats, or None if it isn't one.
+    """
+    if isinstance(reply, bytes):
+        reply = reply.decode('utf-8')
+    if not reply.startswith('SUCCESS:'):
+        return None
+    values = {}
+    for item in reply[8:].strip().split(','):
+        key, _sep, value = item.partition('=')
+        values[key.strip()] = value
+    return LoadStats._make([values.get(field, '') for field in LoadStats._fields])
+
+
+class LogEntry(_Record):
+    """
+        One line of the server's log, from 'log' or a >LOG notification:
+        unix time, flags (I, F, N, W, D) and the message.
+    """
+    _fields = ('time', 'flags', 'message')
+    _ints = frozenset(['time'])
+    # The message may have commas of its own.
+    _splits = 2
+    __slots__ = _fields
+
+
+class StateEntry(_Record):
+    """
+        One change of the server's state, from 'state' or a >STATE
+        notification.  Older servers leave the later fields out.
+    """
+    _fields = ('time', 'state', 'description', 'local_ip', 'remote_ip', 'remote_port',
+               'local_address', 'local_port', 'local_ipv6')
+    _ints = frozenset(['time', 'remote_port', 'local_port'])
+    _splits = -1
+    __slots__ = _fields
+
+
+def parse_history(lines, kind, since=None, until=None):
+    """
+        Turn the lines of a 'log' or 'state' history reply into kind
+        records (LogEntry or StateEntry), oldest first, yielding each as
+        its line is seen.  Entries from before since (a unix time) are
+        passed over without being parsed, and at the first one from
+        after until we stop and close lines, so a socket reply isn't
+        read any further than that (what's left is thrown away unparsed).
+        Lines that aren't entries (SUCCESS:, END, ERROR:) are skipped.
+    """
+    try:
+        for line in lines:
+            if not line[:1].isdigit():
+                continue
+            comma = line.find(b',' if isinstance(line, bytes) else ',')
+            if comma < 0:
+                continue
+            try:
+                when = int(line[:comma])
+            except ValueError:
+                continue
+            if since is not None and when < since:
+                continue
+            if until is not None and when > until:
+                return
+            if isinstance(line, bytes):
+                line = line.decode('utf-8', 'replace')
+            yield kind._make(line.rstrip('\r\n').split(',', kind._splits))
+    finally:
+        close = getattr(lines, 'close', None)
+        if close is not None:
+            close()
+
+
+class Status(object):
+    """
+        A parsed status snapshot: both tables, plus indexes for O(1)
+        lookups by common name, real address and virtual address.
+        A common name can have several sessions (duplicate-cn), so
+        by_common_name maps to a list of clients.
+    """
+    __slots__ = ('clients', 'routes', 'by_common_name', 'by_real_address',
+                 'by_virtual_address')
+
+    def __init__(self, records=()):
+        """
+            Build the snapshot from Client and Route records, such as
+            those from parse_status or VPNmgmt.iter_status.
+        """
+        self.clients = []
+        self.routes = []
+        self.by_common_name = {}
+        self.by_real_address = {}
+        self.by_virtual_address = {}
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        """
+            Add one Client or Route record to the tables and indexes.
+        """
+        if isinstance(record, Client):
+            self.clients.append(record)
+            self.by_common_name.setdefault(record.common_name, []).append(record)
+            self.by_real_address[record.real_address] = record
+        elif isinstance(record, Route):
+            self.routes.append(record)
+            self.by_virtual_address[record.virtual_address] = record
+
+    def getusers(self):
+        """
+            Return the connected users, in the form VPNmgmt.getusers does.
+        """
+        return _users_from_records(self.routes)
+
+    def __len__(self):
+        return len(self.clients)
+
+
+# Status column titles, as openvpn sends them in its HEADER rows (and
+# in status 1's header lines), and the record fields they fill in.
+_COLUMN_FIELDS = {
+    'Common Name': 'common_name',
+    'Real Address': 'real_address',
+    'Virtual Address': 'virtual_address',
+    'Virtual IPv6 Address': 'virtual_ipv6_address',
+    'Bytes Received': 'bytes_received',
+    'Bytes Sent': 'bytes_sent',
+    'Connected Since': 'connected_since',
+    'Connected Since (time_t)': 'connected_since_t',
+    'Username': 'username',
+    'Client ID': 'client_id',
+    'Peer ID': 'peer_id',
+    'Data Channel Cipher': 'cipher',
+    'Last Ref': 'last_ref',
+    'Last Ref (time_t)': 'last_ref_t',
+}
+# Row prefixes of the status 2/3 tables.
+_TABLES = {'CLIENT_LIST': Client, 'ROUTING_TABLE': Route}
+# Columns to assume if a server sends rows without a HEADER first.
+_DEFAULT_HEADERS = {
+    Client: ('Common Name', 'Real Address', 'Virtual Address', 'Virtual IPv6 Address',
+             'Bytes Received', 'Bytes Sent', 'Connected Since', 'Connected Since (time_t)',
+             'Username', 'Client ID', 'Peer ID', 'Data Channel Cipher'),
+    Route: ('Virtual Address', 'Common Name', 'Real Address', 'Last Ref', 'Last Ref (time_t)'),
+}
+_V1_HEADERS = {
+    Client: ('Common Name', 'Real Address', 'Bytes Received', 'Bytes Sent', 'Connected Since'),
+    Route: ('Virtual Address', 'Common Name', 'Real Address', 'Last Ref'),
+}
+# (record type, header) -> layout.  A server sends the same headers
+# every time, so each openvpn version's layout is worked out just once.
+_LAYOUTS = {}
+
+
+def _layout(kind, header):
+    """
+        Work out from a header's column titles which column holds each
+        of kind's fields (None for those this server doesn't send).
+        Columns we don't know about are skipped, so new ones added by
+        later openvpn versions don't upset anything.
+    """
+    key = (kind, header)
+    layout = _LAYOUTS.get(key)
+    if layout is None:
+        positions = {}
+        for index, title in enumerate(header):
+            positions.setdefault(_COLUMN_FIELDS.get(title), index)
+        layout = _LAYOUTS[key] = tuple(positions.get(field) for field in kind._fields)
+    return layout
+
+
+def _row(kind, fields, layout):
+    """
+        Build a record from a split row, using a layout from _layout.
+    """
+    width = len(fields)
+    return kind._make([fields[index] if index is not None and index < width else None
+                       for index in layout])
+
+
+def parse_status(lines):
+    """
+        Turn the lines of a 'status 1', 'status 2' or 'status 3' reply
+        into Client and Route records, yielding each as soon as its line
+        has been seen.  lines may be bytes or str, with or without their
+        line endings, so this works as well on a socket as on a string.
+        Anything that isn't a table row (including an ERROR: reply) is
+        skipped.
+
+        Columns are found by their titles in the HEADER rows (or status
+        1's header lines), not by position, and each row is split just
+        once on the delimiter, so this keeps working as openvpn adds
+        columns and costs time linear in the size of the reply.
+    """
+    delimiter = None
+    layouts = {}
+    # status 1 has no row prefixes, so we track which table we're in,
+    # and whether its header line is still to come.
+    section = None
+    want_header = False
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        line = line.rstrip('\r\n')
+        if delimiter is None:
+            if line.startswith('TITLE'):
+                # version 2 or 3: comma or tab after TITLE tells us which.
+                delimiter = line[5:6] or ','
+                continue
+            # version 1 or an error condition.
+            delimiter = ''
+        if delimiter:
+            table, _sep, rest = line.partition(delimiter)
+            kind = _TABLES.get(table)
+            if kind is not None:
+                layout = layouts.get(kind)
+                if layout is None:
+                    layout = layouts[kind] = _layout(kind, _DEFAULT_HEADERS[kind])
+                yield _row(kind, rest.split(delimiter), layout)
+            elif table == 'HEADER':
+                table, _sep, titles = rest.partition(delimiter)
+                kind = _TABLES.get(table)
+                if kind is not None:
+                    layouts[kind] = _layout(kind, tuple(titles.split(delimiter)))
+        elif line == 'OpenVPN CLIENT LIST':
+            section = Client
+            want_header = True
+        elif line == 'ROUTING TABLE':
+            section = Route
+            want_header = True
+        elif line in ('GLOBAL STATS', 'END'):
+            section = None
+        elif section is not None and not line.startswith('Updated,'):
+            fields = line.split(',')
+            if want_header:
+                want_header = False
+                if fields[0] in _COLUMN_FIELDS:
+                    layouts[section] = _layout(section, tuple(fields))
+                    continue
+            layout = layouts.get(section)
+            if layout is None:
+                layout = layouts[section] = _layout(section, _V1_HEADERS[section])
+            yield _row(section, fields, layout)
+
+
+def _users_from_records(records):
+    """
+        Build the getusers dict out of parsed status records.
+    """
+    return {username: (username, real_address)
+            for username, real_address in _iter_users(records)}
+
+
+def _iter_users(records):
+    """
+        Yield (username, real address) for each connected session in
+        parsed status records; a user with several sessions comes up
+        once for each (getusers keeps the last).
+    """
+    for record in records:
+        if not isinstance(record, Route):
+            continue
+        username = record.common_name
+        if username == 'UNDEF':
+            # This is subtle so needs a lot of explaining.
+            #
+            # openvpn source code, src/openvpn/multi.c
+            # multi_print_status calls tls_common_name and if tls_multi is NULL / not fully
+            # established (which can happen due to deferred authentication and races between
+            # auth / negotiations and status delays), the username in ROUTING_TABLE can come
+            # out as 'UNDEF' briefly, usually "one iteration of a status file update."
+            #
+            # Since it's a hard-coded word in the source we're replicating that here and
+            # ignoring any UNDEF user, since it's not really a user.  This DOES mean that if
+            # you have a user with the certificate Common Name of literal string 'UNDEF'
+            # that we're going to suppress that they're connecting, but, you deserve to lose.
+            continue
+        yield username, record.real_address
+
+
+class ClientRate(_Record):
+    """
+        One client's traffic rates from StatusHistory: bytes per second
+        received from (rx) and sent to (tx) the client over the samples
+        looked at, or None with fewer than two samples.
+    """
+    _fields = ('client_id', 'common_name', 'real_address', 'connected_since_t',
+               'rx_rate', 'tx_rate')
+    __slots__ = _fields
+
+
+class StatusHistory(object):
+    """
+        The last `samples` byte counts of every client, for rates and
+        rankings without keeping whole status snapshots around.  Feed it
+        with add_status() from status polls, or add_event() with
+        >BYTECOUNT_CLI (and >CLIENT:) notifications, or both.
+
+        Samples live in flat array columns (time, bytes received, bytes
+        sent), `samples` entries per client slot used as a ring, and the
+        slots of clients that leave are reused.  So memory is fixed at
+        about 24 bytes per sample per client slot (10000 clients with
+        60 samples is some 15MB, or up to twice that as slots are added
+        by doubling) and doesn't churn as polls come in.
+        Clients are keyed by client id, or by (common name, real address)
+        where the status has none.
+    """
+    def __init__(self, samples=60):
+        if samples < 2:
+            raise ValueError('rates need at least 2 samples')
+        self.samples = samples
+        self._slots = {}
+        self._free = []
+        # Per slot: (client id, common name, real address), or None when free.
+        self._names = []
+        self._since = array.array('q')
+        self._head = array.array('l')
+        self._count = array.array('l')
+        # Per sample: slot * samples + position in that slot's ring.
+        self._times = array.array('d')
+        self._rx = array.array('Q')
+        self._tx = array.array('Q')
+
+    def __len__(self):
+        return len(self._slots)
+
+    @property
+    def nbytes(self):
+        """
+            Bytes held by the sample columns.
+        """
+        return sum(column.itemsize * len(column) for column in
+                   (self._since, self._head, self._count, self._times, self._rx, self._tx))
+
+    def _grow(self):
+        """
+            Double the number of client slots.
+        """
+        old = len(self._names)
+        extra = max(old, 64)
+        self._names.extend([None] * extra)
+        # Hand out the lowest slots first.
+        self._free.extend(range(old + extra - 1, old - 1, -1))
+        for column in (self._since, self._head, self._count):
+            column.extend(array.array(column.typecode, bytes(column.itemsize * extra)))
+        for column in (self._times, self._rx, self._tx):
+            column.extend(array.array(column.typecode, bytes(column.itemsize * extra * self.samples)))
+
+    def _slot(self, key, common_name=None, real_address=None, since=None):
+        """
+            The slot for a client, taking a free one if it is new, with
+            whatever names and connect time we were given.
+        """
+        slot = self._slots.get(key)
+        if slot is None:
+            if not self._free:
+                self._grow()
+            slot = self._free.pop()
+            self._slots[key] = slot
+            self._head[slot] = 0
+            self._count[slot] = 0
+            self._since[slot] = 0
+            self._names[slot] = (key if isinstance(key, int) else None, common_name, real_address)
+        elif common_name is not None and self._names[slot][1] is None:
+            self._names[slot] = (self._names[slot][0], common_name, real_address)
+        if since:
+            self._since[slot] = since
+        return slot
+
+    def _sample(self, slot, when, received, sent):
+        """
+            Write one sample into a slot's ring.
+        """
+        head = self._head[slot]
+        index = slot * self.samples + head
+        self._times[index] = when
+        self._rx[index] = received or 0
+        self._tx[index] = sent or 0
+        self._head[slot] = (head + 1) % self.samples
+        if self._count[slot] < self.samples:
+            self._count[slot] += 1
+
+    def _drop(self, key):
+        """
+            Forget a client and free its slot.
+        """
+        slot = self._slots.pop(key, None)
+        if slot is not None:
+            self._names[slot] = None
+            self._free.append(slot)
+
+    def add_status(self, status, when=None):
+        """
+            Take a sample of every client in a Status (or the records of
+            iter_status), at time.monotonic() unless told otherwise.
+            Clients missing from it are gone, and are forgotten.
+        """
+        when = time.monotonic() if when is None else when
+        if isinstance(status, Status):
+            status = status.clients
+        seen = set()
+        for record in status:
+            if not isinstance(record, Client):
+                continue
+            key = record.client_id
+            if key is None:
+                key = (record.common_name, record.real_address)
+            seen.add(key)
+            slot = self._slot(key, record.common_name, record.real_address,
+                              record.connected_since_t)
+            self._sample(slot, when, record.bytes_received, record.bytes_sent)
+        for key in self._slots.keys() - seen:
+            self._drop(key)
+
+    def add_event(self, event, when=None):
+        """
+            Take in a notification: >BYTECOUNT_CLI is a sample of that
+            client, >CLIENT:ESTABLISHED names a client, and
+            >CLIENT:DISCONNECT forgets one.  Others are ignored.  Suits
+            VPNmgmt.add_event_callback.
+        """
+        cid = event.client_id
+        if cid is None:
+            return
+        if event.kind == 'BYTECOUNT_CLI' and len(event.args) >= 3:
+            when = time.monotonic() if when is None else when
+            self._sample(self._slot(cid), when, int(event.args[1]), int(event.args[2]))
+        elif event.kind == 'CLIENT:ESTABLISHED' and event.env:
+            env = event.env
+            address = None
+            if env.get('trusted_ip'):
+                address = f"{env['trusted_ip']}:{env.get('trusted_port', '')}"
+            since = env.get('time_unix', '')
+            self._slot(cid, env.get('common_name'), address, int(since) if since.isdigit() else None)
+        elif event.kind == 'CLIENT:DISCONNECT':
+            self._drop(cid)
+
+    def _rate(self, slot, window):
+        """
+            (rx, tx) bytes per second for a slot, from its newest sample
+            back to the oldest one no more than window seconds older
+            (all of them with no window); (None, None) if there aren't
+            two such samples.  Counters that went backwards (a reset)
+            count as no traffic.
+        """
+        count = self._count[slot]
+        if count < 2:
+            return None, None
+        base = slot * self.samples
+        newest = base + (self._head[slot] - 1) % self.samples
+        position = (self._head[slot] - count) % self.samples
+        if window is not None:
+            cutoff = self._times[newest] - window
+            while count > 2 and self._times[base + position] < cutoff:
+                position = (position + 1) % self.samples
+                count -= 1
+        oldest = base + position
+        elapsed = self._times[newest] - self._times[oldest]
+        if elapsed <= 0:
+            return None, None
+        return (max(self._rx[newest] - self._rx[oldest], 0) / elapsed,
+                max(self._tx[newest] - self._tx[oldest], 0) / elapsed)
+
+    def _record(self, slot, window):
+        """
+            A slot as a ClientRate.
+        """
+        cid, common_name, real_address = self._names[slot]
+        rx_rate, tx_rate = self._rate(slot, window)
+        return ClientRate(cid, common_name, real_address, self._since[slot] or None,
+                          rx_rate, tx_rate)
+
+    def rates(self, window=None):
+        """
+            A ClientRate for every client, over the last window seconds
+            of samples (or all we have).
+        """
+        return [self._record(slot, window) for slot in self._slots.values()]
+
+    def top(self, count=10, by='total', window=None):
+        """
+            The count clients moving the most bytes per second, by 'rx',
+            'tx' or 'total', busiest first, as ClientRates.
+        """
+        if by not in ('rx', 'tx', 'total'):
+            raise ValueError("by must be 'rx', 'tx' or 'total'")
+        ranked = []
+        for slot in self._slots.values():
+            rx_rate, tx_rate = self._rate(slot, window)
+            if rx_rate is None:
+                continue
+            rate = {'rx': rx_rate, 'tx': tx_rate, 'total': rx_rate + tx_rate}[by]
+            ranked.append((rate, slot))
+        return [self._record(slot, window)
+                for _rate, slot in heapq.nlargest(count, ranked, key=lambda item: item[0])]
+
+    def longest_connected(self, count=10):
+        """
+            The count clients connected the longest, as ClientRates,
+            oldest connection first.  Clients whose connect time we
+            don't know are left out.
+        """
+        since = self._since
+        slots = [slot for slot in self._slots.values() if since[slot]]
+        return [self._record(slot, None)
+                for slot in heapq.nsmallest(count, slots, key=since.__getitem__)]
+
+
+class StatusFileSource(object):
+    """
+        Reads the file openvpn writes with --status, instead of asking
+        over the management socket (which makes openvpn serialize the
+        whole table and can only serve one client at a time).  The file
+        is memory-mapped and parsed only when its size or mtime has
+        changed since the last look; otherwise the parsed result is
+        served from cache, so it can be polled as often as you like.
+        The file is only rewritten every --status interval, so results
+        are as fresh as that.
+    """
+    def __init__(self, path):
+        """
+            path: the file named in openvpn's --status option.
+        """
+        self.path = path
+        self.parses = 0
+        self._stamp = None
+        self._status = None
+        self._users = None
+
+    def _refresh(self):
+        """
+            Reparse the file if it has changed.  openvpn rewrites it in
+            place, so a file caught half-written (no END yet) is left
+            for next time, and the last good parse served meanwhile.
+        """
+        stat = os.stat(self.path)
+        stamp = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if stamp == self._stamp:
+            return
+        with open(self.path, 'rb') as handle:
+            if stat.st_size == 0:
+                status = None
+            else:
+                with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    if not mapped[-16:].rstrip().endswith(b'END'):
+                        status = None
+                    else:
+                        status = Status(parse_status(iter(mapped.readline, b'')))
+        if status is None:
+            if self._status is not None:
+                return
+            status = Status()
+        self._status = status
+        self._users = None
+        self._stamp = stamp
+        self.parses += 1
+
+    def getstatus(self):
+        """
+            Return the file's contents as a Status snapshot.  This is
+            the cached object, shared between callers.
+        """
+        self._refresh()
+        return self._status
+
+    def getusers(self):
+        """
+            Returns a dict of the users connected to the VPN, exactly
+            as VPNmgmt.getusers does.
+        """
+        self._refresh()
+        if self._users is None:
+            self._users = self._status.getusers()
+        return dict(self._users)
+
+
+class UserTable(object):
+    """
+        A local copy of the connected-users table (as getusers returns
+        it), kept current from >CLIENT:ESTABLISHED / >CLIENT:DISCONNECT
+        notifications so that it doesn't need a full status each time.
+        A full resync from a status snapshot is needed at the start,
+        and every resync_interval seconds after as a safety net.
+        Sessions are tracked by client id, since one common name may
+        be connected more than once.
+    """
+    def __init__(self, resync_interval=300.0):
+        self.resync_interval = resync_interval
+        self.last_resync = None
+        self.users = {}
+        # client id -> (common name, real address)
+        self._sessions = {}
+        # common name -> {client id: real address}
+        self._by_name = {}
+        # common names handed out by the last call to changes()
+        self._reported = set()
+
+    def stale(self):
+        """
+            True if a full resync is due.
+        """
+        if self.last_resync is None:
+            return True
+        if self.resync_interval is None:
+            return False
+        return time.monotonic() - self.last_resync >= self.resync_interval
+
+    def resync(self, records):
+        """
+            Replace the table with what a status snapshot (Client and
+            Route records) says.  Users count once they have a route,
+            just as in getusers.
+        """
+        records = list(records)
+        routed = _users_from_records(records)
+        routed_addresses = {address for _name, address in routed.values()}
+        sessions = {}
+        by_name = {}
+        for record in records:
+            if isinstance(record, Client) and record.real_address in routed_addresses:
+                key = record.client_id if record.client_id is not None else record.real_address
+                sessions[key] = (record.common_name, record.real_address)
+                by_name.setdefault(record.common_name, {})[key] = record.real_address
+        self._sessions = sessions
+        self._by_name = by_name
+        self.users = routed
+        self.last_resync = time.monotonic()
+
+    def apply(self, event):
+        """
+            Update the table from one Event; anything other than a
+            client establishing or disconnecting is ignored.
+        """
+        cid = event.client_id
+        if event.kind == 'CLIENT:ESTABLISHED' and event.env:
+            name = event.env.get('common_name')
+            if not name or name == 'UNDEF':
+                return
+            ip_address = event.env.get('trusted_ip') or event.env.get('trusted_ip6')
+            port = event.env.get('trusted_port')
+            address = f'{ip_address}:{port}' if ip_address and port else ip_address
+            self._sessions[cid] = (name, address)
+            self._by_name.setdefault(name, {})[cid] = address
+            self.users[name] = (name, address)
+        elif event.kind == 'CLIENT:DISCONNECT':
+            session = self._sessions.pop(cid, None)
+            if session is None:
+                return
+            name = session[0]
+            others = self._by_name.get(name, {})
+            others.pop(cid, None)
+            if others:
+                self.users[name] = (name, next(reversed(others.values())))
+            else:
+                self._by_name.pop(name, None)
+                self.users.pop(name, None)
+
+    def changes(self):
+        """
+            Return (users, added, removed): a copy of the table, and the
+            sets of common names that appeared and disappeared since the
+            previous call.
+        """
+        current = set(self.users)
+        added = current - self._reported
+        removed = self._reported - current
+        self._reported = current
+        return dict(self.users), added, removed
+
+
+class CommandStats(object):
+    """
+        Totals for one command verb in Metrics.  histogram counts calls
+        by round trip time, one count per Metrics.latency_buckets bound
+        (each call lands under the first bound it doesn't exceed).
+    """
+    __slots__ = ('calls', 'commands', 'errors', 'seconds', 'histogram',
+                 'bytes_sent', 'bytes_received', 'recv_calls')
+
+    def __init__(self, buckets):
+        self.calls = 0
+        self.commands = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.histogram = [0] * buckets
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.recv_calls = 0
+
+    def _asdict(self):
+        """
+            The totals, as a dict.
+        """
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class Metrics(object):
+    """
+        Instrumentation for VPNmgmt and friends.  Nothing is measured
+        unless a client's metrics attribute is set, so it costs nothing
+        until asked for:
+
+            client.metrics = Metrics()
+
+        One Metrics can be shared by several clients (the clients of a
+        VPNmgmtPool, say).  For each command verb ('status', 'kill', ...
+        never the arguments, so no user names turn up as labels) it
+        keeps a CommandStats: calls and round trip latency histogram,
+        bytes sent and received, and the recv calls the replies took.
+        A batch from kill_many is one call of many commands.  It also
+        times the parsing in getusers, and counts reconnects and errors
+        (by exception name).
+
+        snapshot() returns all of that as plain dicts, for a Prometheus
+        collector to read.  For pushing to StatsD and the like, hooks
+        are called as each measurement is made:
+            hook('command', verb, {seconds, bytes_sent, bytes_received,
+                                   recv_calls, commands, error})
+            hook('parse', name, {seconds})
+            hook('counter', name, {value})
+        Hooks run on the thread that made the call, so keep them quick.
+    """
+    # Upper bounds, in seconds, of the latency histogram's buckets.
+    latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                       0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hooks = []
+        self.commands = {}
+        self.parses = {}
+        self.counters = collections.Counter()
+
+    def reset(self):
+        """
+            Zero everything (hooks stay).
+        """
+        with self._lock:
+            self.commands = {}
+            self.parses = {}
+            self.counters = collections.Counter()
+
+    def add_hook(self, hook):
+        """
+            Have hook(kind, name, fields) called with each measurement.
+        """
+        self.hooks.append(hook)
+
+    def observe_command(self, verb, seconds, sent, received, recvs, count=1, error=None):
+        """
+            Record one round trip of count commands of the given verb.
+        """
+        with self._lock:
+            stats = self.commands.get(verb)
+            if stats is None:
+                stats = self.commands[verb] = CommandStats(len(self.latency_buckets))
+            stats.calls += 1
+            stats.commands += count
+            stats.seconds += seconds
+            stats.histogram[bisect.bisect_left(self.latency_buckets, seconds)] += 1
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+            stats.recv_calls += recvs
+            if error is not None:
+                stats.errors += 1
+                self.counters[f'errors.{type(error).__name__}'] += 1
+        for hook in self.hooks:
+            hook('command', verb, {'seconds': seconds, 'bytes_sent': sent,
+                                   'bytes_received': received, 'recv_calls': recvs,
+                                   'commands': count, 'error': error})
+
+    def observe_parse(self, name, seconds):
+        """
+            Record time spent parsing, for the named call.
+        """
+        with self._lock:
+            calls, total = self.parses.get(name, (0, 0.0))
+            self.parses[name] = (calls + 1, total + seconds)
+        for hook in self.hooks:
+            hook('parse', name, {'seconds': seconds})
+
+    def increment(self, name, value=1):
+        """
+            Add to the named counter.
+        """
+        with self._lock:
+            self.counters[name] += value
+        for hook in self.hooks:
+            hook('counter', name, {'value': value})
+
+    def snapshot(self):
+        """
+            Everything so far, as plain dicts:
+            {
+                'commands': {verb: {calls, commands, errors, seconds,
+                                    histogram, bytes_sent, ...}},
+                'parses': {name: {'calls': n, 'seconds': total}},
+                'counters': {name: value},
+                'latency_buckets': [bounds of the histogram buckets],
+            }
+        """
+        with self._lock:
+            commands = {}
+            for verb, stats in self.commands.items():
+                commands[verb] = stats._asdict()
+                commands[verb]['histogram'] = list(stats.histogram)
+            return {
+                'commands': commands,
+                'parses': {name: {'calls': calls, 'seconds': seconds}
+                           for name, (calls, seconds) in self.parses.items()},
+                'counters': dict(self.counters),
+                'latency_buckets': list(self.latency_buckets),
+            }
+
+
 class VPNmgmt(object):
     """
-        class vpnmgmt creates a socket to the openvpn management server
-        and interacts with that socket.  This is just socket logic.
+        class vpnmgmt creates a socket to the openvpn management server
+        and interacts with that socket.  This is just socket logic.
+    """
+    # Seconds the server may go silent mid-reply before we give up.
+    read_timeout = 10.0
+    # Seconds connect() may take (including the welcome banner) by default.
+    connect_timeout = 10.0
+    # Most events we hold for poll_events/iter_events; older ones drop.
+    event_backlog = 10000
+    # Set to a Metrics to have commands measured.
+    metrics = None
+
+    def __init__(self, socket_path, password=None):
+        """
+            Establish a socket for eventual use connecting to
+            a server at a certain socket_path: the absolute path of a
+            unix socket, or host:port of a TCP one (see
+            _management_address).  password is for servers that ask
+            for one ('management ... pw-file').
+        """
+        # It might be better to validate on "is file, is socket" but
+        # we do not presently use a real socket in testing, so all
+        # this tests is, is this an absolute-pathed filename STRING
+        # (or a host:port).  The file may not even exist.
+        self.family, self.address = _management_address(socket_path)
+        self.socket_path = socket_path
+        self.password = password
+        self._make_socket()
+        self._event_parser = EventParser()
+        self.events = collections.deque(maxlen=self.event_backlog)
+        self.event_callbacks = []
+        self.subscriptions = []
+        self.user_table = None
+
+    def _make_socket(self):
+        """
+            Set up a fresh socket, and a reader for it, for connect()
+            to use.
+        """
+        self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family != socket.AF_UNIX:
+            _tune_tcp(self.sock)
+        self.reader = ResponseReader(self.sock)
+        self.reader.notify = self._notification
+
+    def connect(self, timeout=None):
+        """
+            Connect to the server's socket, log in if it asks for a
+            password, and clear out the welcome banner that has no
+            information of use in it.  All of that must happen within
+            timeout seconds (connect_timeout if not given), or
+            ManagementTimeout is raised.  A password that is missing or
+            refused raises PermissionError.
+        """
+        if timeout is None:
+            timeout = self.connect_timeout
+        deadline = _deadline(timeout)
+        try:
+            self.sock.settimeout(timeout or 1e-9)
+            self.sock.connect(self.address)
+        except socket.timeout:
+            self._reset()
+            raise ManagementTimeout(f'could not connect within {timeout} seconds')
+        self.sock.settimeout(0.0)
+        try:
+            if self.reader.take_prompt(_PASSWORD_PROMPT, deadline):
+                self._login(deadline)
+            # openvpn management gives a welcome message on connect.
+            # toss it.
+            if not self.reader.skip_banner(deadline):
+                raise ManagementTimeout('no welcome banner from the management server')
+        except (socket.error, OSError):
+            self._reset()
+            raise
+
+    def _login(self, deadline):
+        """
+            Answer the server's password prompt.
+        """
+        if self.password is None:
+            raise PermissionError('the management interface wants a password')
+        self.sock.sendall(f'{self.password}\r\n'.encode('utf-8'))
+        reply = self.reader.read_reply(FRAME_LINE, self.read_timeout, deadline)
+        if not self._success(reply):
+            raise PermissionError('the management interface refused our password')
+
+    def _reset(self):
+        """
+            Drop the connection, for when a reply was given up on part
+            way: whatever is left of it would be read as the answer to
+            the next command.  connect() again to carry on.
+        """
+        try:
+            self.sock.close()
+        except (socket.error, OSError):  # pragma: no cover
+            pass
+        self._make_socket()
+
+    def disconnect(self):
+        """
+            Gracefully leave the connection if possible.
+        """
+        try:
+            self._send('quit')
+        except socket.error:
+            pass
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
+        self.sock.close()
+
+    def _send(self, command, deadline=None):
+        """
+            Since the interactions with openvpn management are mostly
+            call-and-response, this is the internal call to go and do
+            exactly that.  Send a command, read back from the server
+            until its reply is complete (see reply_framing).  Then,
+            return that (sometimes multiline) string to the caller.
+            If that hasn't happened by deadline (a time.monotonic()
+            value), reset the connection and raise ManagementTimeout.
+        """
+        payload = f'{command}\r\n'.encode('utf-8')
+        mark = self._mark() if self.metrics is not None else None
+        try:
+            self.sock.send(payload)
+            # There is no polling for a quiet period here: we return the
+            # moment the reply's last line arrives.  read_timeout only
+            # guards against a server that stops talking altogether.
+            try:
+                data = self.reader.read_reply(reply_framing(command), self.read_timeout, deadline)
+            except ManagementTimeout:
+                self._reset()
+                raise
+        except (socket.error, OSError) as err:
+            if mark is not None:
+                self._record(command, mark, len(payload), error=err)
+            raise
+        if mark is not None:
+            self._record(command, mark, len(payload))
+        return data.decode('utf-8')
+
+    def _mark(self):
+        """
+            Where the reader's counters stand before a command, for
+            _record to take the difference.
+        """
+        reader = self.reader
+        return (reader, time.perf_counter(), reader.bytes_received, reader.recv_calls)
+
+    def _record(self, command, mark, sent, count=1, error=None):
+        """
+            Report a finished command (or count commands sent together)
+            to metrics.  Only the verb is reported, never the arguments.
+        """
+        reader, start, received, recvs = mark
+        self.metrics.observe_command(command.split(None, 1)[0] if command else '',
+                                     time.perf_counter() - start, sent,
+                                     reader.bytes_received - received,
+                                     reader.recv_calls - recvs, count, error)
+
+    def _send_many(self, commands, deadline=None):
+        """
+            Pipelined version of _send: write every command in one go,
+            then read back one reply per command, in order.  Replies
+            are read while the commands are still going out, so neither
+            side can stall with a full socket buffer.
+        """
+        payload = memoryview(''.join(f'{command}\r\n' for command in commands).encode('utf-8'))
+        sent = 0
+        replies = []
+        mark = self._mark() if self.metrics is not None else None
+        try:
+            while sent < len(payload):
+                wait = self.read_timeout
+                if deadline is not None:
+                    wait = min(wait, _remaining(deadline))
+                rbuf, wbuf, _ebuf = select.select([self.sock], [self.sock], [], wait)
+                if not rbuf and not wbuf:
+                    if deadline is not None and not _remaining(deadline):
+                        raise ManagementTimeout('commands not all sent by the deadline')
+                    raise socket.timeout('management server stopped accepting commands')
+                if wbuf:
+                    sent += self.sock.send(payload[sent:])
+                if rbuf:
+                    self.reader.fill(0)
+            for command in commands:
+                replies.append(self.reader.read_reply(reply_framing(command), self.read_timeout,
+                                                      deadline).decode('utf-8'))
+        except (socket.error, OSError) as err:
+            if isinstance(err, ManagementTimeout):
+                self._reset()
+                err.replies = replies
+            if mark is not None:
+                self._record(commands[0], mark, sent, len(commands), err)
+            raise
+        if mark is not None:
+            self._record(commands[0], mark, sent, len(commands))
+        return replies
+
+    def _notification(self, line):
+        """
+            Called by the reader with each notification line, whether it
+            turned up between replies or in the middle of one.
+        """
+        event = self._event_parser.feed(line)
+        if event is None:
+            return
+        self.events.append(event)
+        for callback in self.event_callbacks:
+            callback(event)
+
+    def subscribe(self, bytecount=None, state=False, log=False):
+        """
+            Ask the server for real-time notifications: >BYTECOUNT_CLI
+            every bytecount seconds, >STATE changes, and >LOG lines.
+            (>CLIENT: notifications need --management-client-auth on the
+            server and are always sent.)  Returns {command: reply}.
+        """
+        commands = []
+        if bytecount:
+            commands.append(f'bytecount {int(bytecount)}')
+        if state:
+            commands.append('state on')
+        if log:
+            commands.append('log on')
+        replies = {}
+        for command in commands:
+            replies[command] = self._send(command)
+            if command not in self.subscriptions:
+                self.subscriptions.append(command)
+        return replies
+
+    def add_event_callback(self, callback):
+        """
+            Have callback(event) called for every Event as it is read,
+            including ones that arrive while a command is being answered.
+        """
+        self.event_callbacks.append(callback)
+
+    def poll_events(self, timeout=0):
+        """
+            Return the list of Events received so far, waiting up to
+            timeout seconds (None: until something arrives) if there
+            are none yet.
+        """
+        if not self.events:
+            self.reader.read_notifications(timeout)
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+    def iter_events(self):
+        """
+            Yield Events as they arrive, until the server closes.
+            No commands can be sent on this connection meanwhile.
+        """
+        while True:
+            if self.events:
+                yield self.events.popleft()
+            elif not self.reader.read_notifications(None):
+                return
+
+    @staticmethod
+    def _success(input_string):
+        """
+            Indicates if the openvpn management server reports a
+            success (True) or failure (False) condition after
+            we run a command.
+            https://openvpn.net/community-resources/management-interface/
+        """
+        if not isinstance(input_string, bytes):
+            input_string = input_string.encode('utf-8')
+        if input_string.startswith(b'SUCCESS'):
+            return True
+        return False
+
+    def status(self, timeout=None):
+        """
+            Return the status as reported by the openvpn server.
+            This will return status 2 (a comma delimited format)
+            This is just to make parsing easier.
+            Every call here that takes a timeout raises ManagementTimeout
+            (a socket.timeout) if it isn't done in that many seconds.
+        """
+        return self._send('status 2', _deadline(timeout))
+
+    def load_stats(self, timeout=None):
+        """
+            Return the server's LoadStats (client count and total bytes
+            in and out), or None if it wouldn't say.  This is one short
+            line, where status is the whole client table: poll this to
+            find out if there's a reason to fetch the rest.
+        """
+        return parse_load_stats(self._send('load-stats', _deadline(timeout)))
+
+    def getusers(self, timeout=None):
+        """
+            Returns a dict of the users connected to the VPN:
+            {
+                username: (str username, str client-address)
+            }
+            Note that we are using the strict definition of 'connected'
+            as folks in the 'ROUTING_TABLE' (fully established, have a
+            client IP), and not the 'CLIENT_LIST' (half-established,
+            without a client IP).  The reason for this is, there are
+            a lot of script kiddies who will be knocking on your front
+            door, and kicking them off when they're in half-established
+            just ends up causing noise.  You should deal with them via
+            some sort of blocklist instead of this script.  Our focus
+            is removing terminated users who have real connections.
+        """
+        if self.metrics is None:
+            return _users_from_records(self.iter_status(timeout=timeout))
+        # Parsing happens as the reply streams in; the time not spent
+        # waiting on the socket is the time spent parsing.
+        reader = self.reader
+        start, waited = time.perf_counter(), reader.wait_seconds
+        users = _users_from_records(self.iter_status(timeout=timeout))
+        self.metrics.observe_parse('getusers', time.perf_counter() - start -
+                                   (reader.wait_seconds - waited))
+        return users
+
+    def track_users(self, resync_interval=300.0):
+        """
+            Switch on the incremental user table used by
+            getusers_changes().  It is kept current from client
+            notifications, which the server only sends when it runs
+            with --management-client-auth; without that, each resync
+            (every resync_interval seconds) is what picks up changes.
+        """
+        self.user_table = UserTable(resync_interval)
+        self.add_event_callback(self.user_table.apply)
+
+    def getusers_changes(self):
+        """
+            Like getusers, but cheap: returns (users, added, removed)
+            where users is the current getusers dict and added/removed
+            are the sets of users that came and went since the last
+            call.  Only the notifications that arrived since then are
+            read, unless a full resync is due.
+        """
+        if self.user_table is None:
+            self.track_users()
+        if self.user_table.stale():
+            self.user_table.resync(self.iter_status())
+        self.reader.read_notifications(0)
+        return self.user_table.changes()
+
+    def _iter_reply(self, command, deadline=None):
+        """
+            Send a command and return an iterator over the lines of its
+            reply, read from the socket as they are consumed.  Past
+            deadline, the connection is reset and ManagementTimeout
+            raised.
+        """
+        payload = f'{command}\r\n'.encode('utf-8')
+        mark = self._mark() if self.metrics is not None else None
+        self.sock.send(payload)
+        return self._reply_lines(
+            command, self.reader.iter_reply(reply_framing(command), self.read_timeout, deadline),
+            mark, len(payload))
+
+    def _reply_lines(self, command, lines, mark, sent):
+        """
+            Pass lines through, resetting the connection if reading them
+            runs out of time, and recording the command once they have
+            all been read if we are measuring.
+        """
+        error = None
+        try:
+            yield from lines
+        except (socket.error, OSError) as err:
+            error = err
+            if isinstance(err, ManagementTimeout):
+                self._reset()
+            raise
+        finally:
+            if mark is not None:
+                self._record(command, mark, sent, error=error)
+
+    def getstatus(self, version=2, timeout=None):
+        """
+            Return the server's status as a Status snapshot, with both
+            tables parsed and indexed.
+        """
+        return Status(self.iter_status(version, timeout))
+
+    def iter_status(self, version=2, timeout=None):
+        """
+            Ask for 'status <version>' (1, 2 or 3) and yield its Client
+            and Route records one by one, parsing each line as it comes
+            off the socket rather than holding the whole dump in memory.
+            Iterate it to the end (or close it) before the next command.
+            With timeout, the whole dump must be in within that many
+            seconds of this call.
+        """
+        return parse_status(self._iter_reply(f'status {version}', _deadline(timeout)))
+
+    def log(self, count=None, since=None, until=None, timeout=None):
+        """
+            Yield the server's log history as LogEntry records, oldest
+            first, parsing each line as it comes off the socket: the
+            last count lines (all of them by default), or only those
+            from since to until (unix times), stopping at the first one
+            past until.  Iterate it to the end (or close it) before the
+            next command.
+        """
+        return self._history('log', LogEntry, count, since, until, timeout)
+
+    def state(self, count=None, since=None, until=None, timeout=None):
+        """
+            Yield the server's state history as StateEntry records, as
+            log does for the log.
+        """
+        return self._history('state', StateEntry, count, since, until, timeout)
+
+    def _history(self, kind, record, count, since, until, timeout):
+        """
+            Ask for kind's history ('log' or 'state') and parse it.
+        """
+        lines = self._iter_reply(f"{kind} {count or 'all'}", _deadline(timeout))
+        return parse_history(lines, record, since, until)
+
+    def follow_log(self, maxlen=1000, timeout=None):
+        """
+            Return a deque of the latest maxlen LogEntry records, filled
+            from the history and then kept current with >LOG lines as
+            notifications are read (by poll_events, iter_events or any
+            command).  Only maxlen entries are ever held, however long
+            the log is or however long this runs.
+        """
+        return self._follow('log', LogEntry, maxlen, timeout)
+
+    def follow_state(self, maxlen=100, timeout=None):
+        """
+            Like follow_log, for StateEntry records and >STATE changes.
+        """
+        return self._follow('state', StateEntry, maxlen, timeout)
+
+    def _follow(self, kind, record, maxlen, timeout):
+        """
+            Switch kind's real-time notifications on, asking for the
+            last maxlen entries of its history along with that, and keep
+            both in a ring buffer.
+        """
+        entries = collections.deque(maxlen=maxlen)
+        source = kind.upper()
+
+        def append(event):
+            ''' Add a live entry to the buffer '''
+            if event.kind == source:
+                entries.append(record._make(event.args))
+        # Registered first: live entries may turn up in the middle of
+        # the history's reply.
+        self.add_event_callback(append)
+        lines = self._iter_reply(f'{kind} on {maxlen}', _deadline(timeout))
+        entries.extend(parse_history(lines, record))
+        if f'{kind} on' not in self.subscriptions:
+            self.subscriptions.append(f'{kind} on')
+        return entries
+
+    def kill(self, user, commit=False, timeout=None):
+        """
+            Disconnect a single user.  Does not check
+            if they were there or not.
+            Returns True/False depending on if the server
+            reports a success or not.
+        """
+        if commit:
+            ret = self._send(f'kill {user}', _deadline(timeout))
+        else:
+            # Send something useless, just to make testing
+            # behave a bit more like real life.
+            ret = self._send('version', _deadline(timeout))
+        return (self._success(ret), ret)
+
+    def kill_many(self, users, commit=False, timeout=None):
+        """
+            Disconnect many users in one round trip: all the kill
+            commands go out in a single write and the replies are read
+            back in order.  Returns a dict of
+            {
+                user: (bool success, str server reply)
+            }
+            as kill would for each user.  Without commit, this sends
+            one 'version' (as kill does) and reports it for everyone.
+        """
+        # Duplicates would only earn a 'not found' the second time.
+        users = list(dict.fromkeys(users))
+        if not users:
+            return {}
+        deadline = _deadline(timeout)
+        if not commit:
+            ret = self._send('version', deadline)
+            return {user: (self._success(ret), ret) for user in users}
+        replies = self._send_many([f'kill {user}' for user in users], deadline)
+        return {user: (self._success(ret), ret) for user, ret in zip(users, replies)}
+
+
+class PersistentVPNmgmt(VPNmgmt):
+    """
+        A long-lived, self-healing VPNmgmt for daemons that want to keep
+        one warm connection (openvpn only serves one management client
+        at a time, so short-lived ones fight over it).  A dead
+        connection is noticed when a command fails or finds the socket
+        closed; it is then reopened, with exponential backoff, any
+        subscribe()d notifications are switched back on, and the
+        command is tried once more.  keepalive() (or the thread from
+        start_keepalive()) sends a 'pid' when the link has been idle.
+        Commands are serialized with a lock so the keepalive thread
+        can share the connection.
+    """
+    def __init__(self, socket_path, keepalive_interval=30.0,
+                 backoff=0.5, max_backoff=30.0, max_attempts=5, password=None):
+        """
+            keepalive_interval: seconds of quiet before keepalive() pings.
+            backoff, max_backoff: first and longest wait between attempts
+            to reconnect; the wait doubles each time.
+            max_attempts: reconnect attempts before giving up (None: never
+            give up).
+            password: as for VPNmgmt.
+        """
+        super().__init__(socket_path, password)
+        self.keepalive_interval = keepalive_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.connected = False
+        self.reconnects = 0
+        self.last_used = time.monotonic()
+        self._lock = threading.RLock()
+        self._keepalive_stop = None
+
+    def connect(self, timeout=None):
+        """
+            Connect, retrying with exponential backoff.  Raises the last
+            error once max_attempts have failed, or if the next attempt
+            would start after timeout seconds (when given).
+        """
+        with self._lock:
+            deadline = _deadline(timeout)
+            delay = self.backoff
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    super().connect(_remaining(deadline))
+                    break
+                except (socket.error, OSError):
+                    self._make_socket()
+                    if self.max_attempts is not None and attempt >= self.max_attempts:
+                        raise
+                    if deadline is not None and _remaining(deadline) <= delay:
+                        raise
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+            self.connected = True
+            self.last_used = time.monotonic()
+
+    def reconnect(self):
+        """
+            Throw away the current connection, open a new one, and
+            switch back on the notifications we had subscribed to.
+        """
+        with self._lock:
+            self.connected = False
+            try:
+                self.sock.close()
+            except (socket.error, OSError):  # pragma: no cover
+                pass
+            self._make_socket()
+            self._event_parser = EventParser()
+            self.connect()
+            self.reconnects += 1
+            if self.metrics is not None:
+                self.metrics.increment('reconnects')
+            for command in self.subscriptions:
+                super()._send(command)
+
+    def _reset(self):
+        """
+            VPNmgmt._reset; the next command will reconnect.
+        """
+        super()._reset()
+        self.connected = False
+
+    def _ensure_connected(self):
+        """
+            Reopen the connection if we know it to be gone.
+        """
+        if not self.connected or self.reader.eof:
+            self.reconnect()
+
+    def _retry(self, method, *args):
+        """
+            Run one of VPNmgmt's senders, and if the connection turns out
+            to be dead, reconnect and run it once more.  Running out of
+            time is not retried.
+        """
+        with self._lock:
+            self._ensure_connected()
+            try:
+                result = method(*args)
+                dead = self.reader.eof
+            except ManagementTimeout:
+                raise
+            except (socket.error, OSError):
+                dead = True
+            if dead:
+                self.reconnect()
+                result = method(*args)
+            self.last_used = time.monotonic()
+            return result
+
+    def _send(self, command, deadline=None):
+        """
+            VPNmgmt._send, reconnecting and retrying once if need be.
+        """
+        if reply_framing(command) == FRAME_NONE:
+            # quit: nothing to retry, and no reason to reconnect for it.
+            with self._lock:
+                return super()._send(command, deadline)
+        return self._retry(super()._send, command, deadline)
+
+    def _send_many(self, commands, deadline=None):
+        """
+            VPNmgmt._send_many, reconnecting and retrying once if need be.
+        """
+        return self._retry(super()._send_many, commands, deadline)
+
+    def _iter_reply(self, command, deadline=None):
+        """
+            VPNmgmt._iter_reply, after making sure we are connected, and
+            holding the lock until the whole reply has been read.  The
+            command goes out when iteration starts.  If the connection
+            is found dead before the first line, it is retried like
+            _send; a reply that is already streaming can't be.
+        """
+        with self._lock:
+            self._ensure_connected()
+            try:
+                lines = super()._iter_reply(command, deadline)
+                first = next(lines, None)
+                dead = first is None and self.reader.eof
+            except ManagementTimeout:
+                raise
+            except (socket.error, OSError):
+                dead = True
+            if dead:
+                self.reconnect()
+                lines = super()._iter_reply(command, deadline)
+                first = next(lines, None)
+            self.last_used = time.monotonic()
+            if first is None:
+                return
+            yield first
+            yield from lines
+
+    def healthy(self):
+        """
+            Ping the server with 'pid'; True if it answered.
+        """
+        try:
+            return self._success(self._send('pid'))
+        except (socket.error, OSError):
+            return False
+
+    def keepalive(self):
+        """
+            Ping the server if the connection has been idle for
+            keepalive_interval seconds, reconnecting if it has died.
+            Returns False if the server couldn't be reached.
+        """
+        if time.monotonic() - self.last_used < self.keepalive_interval:
+            return True
+        return self.healthy()
+
+    def start_keepalive(self):
+        """
+            Call keepalive() from a background thread, so an otherwise
+            idle daemon notices a dead server before it needs it.
+        """
+        if self._keepalive_stop is not None:
+            return
+        self._keepalive_stop = threading.Event()
+        thread = threading.Thread(target=self._keepalive_loop, args=(self._keepalive_stop,))
+        thread.daemon = True
+        thread.start()
+
+    def _keepalive_loop(self, stop):
+        """
+            Body of the keepalive thread.
+        """
+        while not stop.wait(self.keepalive_interval):
+            self.keepalive()
+
+    def disconnect(self):
+        """
+            Stop the keepalive thread and leave the connection.
+        """
+        if self._keepalive_stop is not None:
+            self._keepalive_stop.set()
+            self._keepalive_stop = None
+        with self._lock:
+            self.connected = False
+            super().disconnect()
+
+
+class ThreadSafeVPNmgmt(VPNmgmt):
+    """
+        A VPNmgmt that any number of threads can share.  openvpn serves
+        one management client at a time, so the alternative is an app
+        lock around every call.  Here each command is queued with a
+        future, and a single I/O thread writes it, reads its reply and
+        hands that to whoever is waiting.  Kills jump the queue ahead of
+        everything else, and status dumps go behind it.  Between
+        commands the I/O thread reads notifications, so events and
+        callbacks keep flowing; callbacks run on that thread.
+
+        Before connect() and after disconnect() calls go straight to the
+        socket, as with a plain VPNmgmt.  iter_status() reads the whole
+        reply before handing it over, as the socket can't wait on a
+        caller that is iterating slowly.
+    """
+    # Queue order: lower goes first; commands of equal rank go in order.
+    command_priorities = {'kill': 0, 'client-kill': 0, 'status': 2}
+    default_priority = 1
+
+    def __init__(self, socket_path, password=None):
+        """
+            As VPNmgmt; the I/O thread starts with connect().
+        """
+        super().__init__(socket_path, password)
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._queue_lock = threading.Lock()
+        self._event_cond = threading.Condition()
+        self._io_thread = None
+        self._wake = None
+
+    def connect(self, timeout=None):
+        """
+            Connect, and start the I/O thread.  Once it is running (that
+            is, after a ManagementTimeout reset the connection), the I/O
+            thread does the connecting.
+        """
+        if self._io_thread is not None:
+            return self._submit(self.default_priority, _deadline(timeout), super().connect, timeout)
+        super().connect(timeout)
+        self._wake = socket.socketpair()
+        self._wake[1].setblocking(False)
+        self._io_thread = threading.Thread(target=self._io_loop, name='openvpn-management-io',
+                                           daemon=True)
+        self._io_thread.start()
+
+    def disconnect(self):
+        """
+            Let the I/O thread finish what is queued, stop it, and then
+            leave the connection.
+        """
+        with self._queue_lock:
+            thread, self._io_thread = self._io_thread, None
+            if thread is not None:
+                # After everything else that is queued.
+                self._queue.put((float('inf'), next(self._sequence), None))
+                self._wake[1].send(b'\0')
+        if thread is not None:
+            thread.join()
+            for sock in self._wake:
+                sock.close()
+            self._wake = None
+            with self._event_cond:
+                self._event_cond.notify_all()
+        super().disconnect()
+
+    def _priority(self, command):
+        """
+            Where a command goes in the queue.
+        """
+        return self.command_priorities.get(command.split(' ', 1)[0], self.default_priority)
+
+    def _submit(self, priority, deadline, method, *args):
+        """
+            Run method(*args) on the I/O thread and return its result
+            (or raise its exception) here.  If it is still queued at
+            deadline, it is dropped and ManagementTimeout raised; one
+            that has started is bound by the deadline itself.
+        """
+        with self._queue_lock:
+            thread = self._io_thread
+            if thread is not None and thread is not threading.current_thread():
+                future = concurrent.futures.Future()
+                self._queue.put((priority, next(self._sequence), (future, method, args)))
+                try:
+                    self._wake[1].send(b'\0')
+                except BlockingIOError:
+                    pass  # plenty of wake-ups are pending already
+            else:
+                future = None
+        if future is None:
+            return method(*args)
+        try:
+            return future.result(_remaining(deadline))
+        except concurrent.futures.TimeoutError:
+            if future.cancel():
+                raise ManagementTimeout('command still queued at the deadline')
+        return future.result()
+
+    def _io_loop(self):
+        """
+            The I/O thread: run queued jobs in order, and read
+            notifications while there are none.
+        """
+        while True:
+            try:
+                _priority, _sequence, job = self._queue.get_nowait()
+            except queue.Empty:
+                self._wait_for_work()
+                continue
+            if job is None:
+                return
+            future, method, args = job
+            if not future.set_running_or_notify_cancel():  # pragma: no cover
+                continue
+            try:
+                future.set_result(method(*args))
+            except BaseException as err:  # pylint: disable=broad-except
+                future.set_exception(err)
+
+    def _wait_for_work(self):
+        """
+            Read notifications until a job is queued.
+        """
+        # Lines already buffered behind the last reply come first.
+        try:
+            open_ = self.reader.read_notifications(0)
+        except (socket.error, OSError):
+            # Gone; the next command will say so to its caller.
+            self.reader.eof = True
+            open_ = False
+        watch = [self._wake[0], self.sock] if open_ else [self._wake[0]]
+        if not open_:
+            with self._event_cond:
+                self._event_cond.notify_all()
+        rbuf, _wbuf, _ebuf = select.select(watch, [], [])
+        if self._wake[0] in rbuf:
+            self._wake[0].recv(4096)
+
+    def _notification(self, line):
+        """
+            As VPNmgmt's, also waking up poll_events/iter_events callers.
+        """
+        super()._notification(line)
+        with self._event_cond:
+            self._event_cond.notify_all()
+
+    def _send(self, command, deadline=None):
+        """
+            VPNmgmt._send, on the I/O thread.
+        """
+        return self._submit(self._priority(command), deadline, super()._send, command, deadline)
+
+    def _send_many(self, commands, deadline=None):
+        """
+            VPNmgmt._send_many, on the I/O thread, ranked by its first
+            command.
+        """
+        return self._submit(self._priority(commands[0]), deadline,
+                            super()._send_many, commands, deadline)
+
+    def _iter_reply(self, command, deadline=None):
+        """
+            VPNmgmt._iter_reply, read in full on the I/O thread.  On the
+            I/O thread itself it streams as usual.
+        """
+        if self._io_thread is threading.current_thread():
+            return super()._iter_reply(command, deadline)
+        lines = self._submit(self._priority(command), deadline,
+                             self._read_reply_lines, command, deadline)
+        return iter(lines)
+
+    def _read_reply_lines(self, command, deadline):
+        """
+            The lines of a command's reply, as a list.
+        """
+        return list(super()._iter_reply(command, deadline))
+
+    def getusers_changes(self):
+        """
+            VPNmgmt.getusers_changes, on the I/O thread.
+        """
+        return self._submit(self._priority('status'), None, super().getusers_changes)
+
+    def poll_events(self, timeout=0):
+        """
+            Return the list of Events received so far, waiting up to
+            timeout seconds (None: until something arrives) if there
+            are none yet.
+        """
+        if self._io_thread is None:
+            return super().poll_events(timeout)
+        with self._event_cond:
+            self._event_cond.wait_for(lambda: self.events, timeout)
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        return events
+
+    def iter_events(self):
+        """
+            Yield Events as they arrive, until the server closes.
+            Unlike VPNmgmt's, other threads can send commands meanwhile.
+        """
+        if self._io_thread is None:
+            yield from super().iter_events()
+            return
+        while True:
+            with self._event_cond:
+                self._event_cond.wait_for(
+                    lambda: self.events or self.reader.eof or self._io_thread is None)
+            if not self.events:
+                return
+            yield self.events.popleft()
+
+
+class _Flight(object):
+    """
+        One fetch in progress, that other callers can wait on.
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def finish(self, result=None, error=None):
+        """
+            Record the outcome and wake the waiters.
+        """
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def wait(self):
+        """
+            Wait for the outcome; a failed fetch raises for everyone.
+        """
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class StatusCoalescer(object):
+    """
+        A single-flight front for a VPNmgmt's status calls, for programs
+        where several parts (an exporter, a kill loop, an admin API) ask
+        for the status independently.  Callers that arrive while a fetch
+        is running wait for it and share its result instead of making
+        openvpn produce another full dump, and with max_age set, a result
+        that young is served from cache.  getusers() and getstatus()
+        share one fetch.  The counters say how it went: fetches (real
+        dumps), coalesced (callers that joined a running fetch) and hits
+        (callers served from cache).
+    """
+    def __init__(self, client, max_age=0.0):
+        """
+            client: the VPNmgmt (or anything with status/getstatus).
+            max_age: seconds a result may be served from cache; 0 means
+            only share fetches that are actually in progress.
+        """
+        self.client = client
+        self.max_age = max_age
+        self.fetches = 0
+        self.coalesced = 0
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._cache = {}
+
+    def _get(self, name, fetch):
+        """
+            Return the result of fetch(), shared with every caller that
+            asks for name while it runs (or within max_age after).
+        """
+        with self._lock:
+            cached = self._cache.get(name)
+            if cached is not None and time.monotonic() - cached[0] < self.max_age:
+                self.hits += 1
+                return cached[1]
+            flight = self._flights.get(name)
+            if flight is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                flight = self._flights[name] = _Flight()
+                self.fetches += 1
+                leader = True
+        if not leader:
+            return flight.wait()
+        try:
+            result = fetch()
+        except Exception as err:
+            with self._lock:
+                del self._flights[name]
+            flight.finish(error=err)
+            raise
+        with self._lock:
+            del self._flights[name]
+            self._cache[name] = (time.monotonic(), result)
+        flight.finish(result)
+        return result
+
+    def status(self):
+        """
+            The status text, as VPNmgmt.status returns it.
+        """
+        return self._get('status', self.client.status)
+
+    def getstatus(self):
+        """
+            The status as a Status snapshot, shared between callers.
+        """
+        return self._get('getstatus', self.client.getstatus)
+
+    def getusers(self):
+        """
+            Returns a dict of the users connected to the VPN, exactly
+            as VPNmgmt.getusers does.
+        """
+        return self.getstatus().getusers()
+
+    def stats(self):
+        """
+            The counters, as a dict.
+        """
+        return {'fetches': self.fetches, 'coalesced': self.coalesced, 'hits': self.hits}
+
+
+class UserPoller(object):
+    """
+        getusers() for polling loops that mostly find nothing changed.
+        Each poll() asks for load-stats, and only fetches the full status
+        when the client count moved since the last poll, or the users
+        we have are max_staleness seconds old.  A client leaving while
+        another arrives leaves the count alone, so that swap is only
+        seen at the next full fetch; max_staleness bounds how late.
+        polls and fetches count calls and full status dumps.
     """
-    def __init__(self, socket_path):
+    def __init__(self, client, max_staleness=60.0):
         """
-            Establish a socket for eventual use connecting to
-            a server at a certain socket_path
-        """
-        if os.path.isabs(socket_path):
-            # It might be better to validate on "is file, is socket" but
-            # we do not presently use a real socket in testing, so all
-            # this tests is, is this an absolute-pathed filename STRING.
-            # The file may not even exist.
-            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            self.socket_path = socket_path
-        else:
-            raise ValueError('only unix sockets are currently supported')
+            client: the VPNmgmt (or anything with load_stats/getusers).
+        """
+        self.client = client
+        self.max_staleness = max_staleness
+        self.users = None
+        self.load_stats = None
+        self.fetched = None
+        self.polls = 0
+        self.fetches = 0
 
-    def connect(self):
+    def _due(self, stats):
         """
-            Connect to the server's socket and clear out the welcome
-            banner that has no information of use in it.
+            Whether stats (or their absence) call for a full fetch.
         """
-        self.sock.settimeout(10.0)
-        self.sock.connect(self.socket_path)
-        # openvpn management gives a welcome message on connect.
-        # toss it, and go into nonblocking mode.
-        self.sock.recv(1024)
-        self.sock.settimeout(0.0)
+        if self.users is None or stats is None or self.load_stats is None:
+            return True
+        if time.monotonic() - self.fetched >= self.max_staleness:
+            return True
+        return stats.nclients != self.load_stats.nclients
+
+    def poll(self, timeout=None):
+        """
+            Returns (users, changed): the getusers dict, and whether it
+            differs from what the previous poll returned.  timeout
+            bounds the whole poll.
+        """
+        deadline = _deadline(timeout)
+        stats = self.client.load_stats(_remaining(deadline))
+        self.polls += 1
+        changed = False
+        if self._due(stats):
+            users = self.client.getusers(_remaining(deadline))
+            self.fetches += 1
+            self.fetched = time.monotonic()
+            changed = users != self.users
+            self.users = users
+        self.load_stats = stats
+        return self.users, changed
+
+    def getusers(self, timeout=None):
+        """
+            The users, as VPNmgmt.getusers, fetched only if need be.
+        """
+        return self.poll(timeout)[0]
+
+
+class ReconcileReport(object):
+    """
+        What a Reconciler run did.  violators maps each kill target (a
+        common name, or a real address) to the (common name, real
+        address) it matched; killed lists the targets the server
+        confirmed, failed maps the rest to the server's reply (or the
+        error), and skipped lists the ones not killed: beyond max_kills,
+        or all of them in a dry run.  timings has the seconds spent in
+        each phase: fetch, evaluate and kill.
+    """
+    __slots__ = ('commit', 'violators', 'killed', 'skipped', 'failed', 'timings')
+
+    def __init__(self, commit):
+        self.commit = commit
+        self.violators = {}
+        self.killed = []
+        self.skipped = []
+        self.failed = {}
+        self.timings = {}
+
+    def __repr__(self):
+        return (f'ReconcileReport(commit={self.commit!r}, violators={len(self.violators)}, '
+                f'killed={len(self.killed)}, skipped={len(self.skipped)}, '
+                f'failed={len(self.failed)}, timings={self.timings!r})')
+
+
+class Reconciler(object):
+    """
+        The 'kill terminated users' job: make the users connected to a
+        server agree with a directory, disconnecting the ones who
+        shouldn't be there.  Say who may stay with allow (common names),
+        who may not with deny (common names or real addresses), and/or
+        predicate(common_name), which returns True for users who may
+        stay.  Answers from predicate are cached for cache_ttl seconds,
+        so a slow directory is asked about each user once in a while,
+        not on every run.  A user any of them objects to is killed.
+
+        Kills go out through kill_many, `concurrency` commands at a
+        time, paced to `rate` kills per second if set.  max_kills caps
+        one run, so that an allow list that came back empty can't clear
+        out the whole server; the rest are skipped.
+    """
+    def __init__(self, client, allow=None, deny=None, predicate=None, cache_ttl=300.0,
+                 rate=None, concurrency=100, max_kills=None):
+        """
+            client: a VPNmgmt, or anything with getusers and kill_many.
+        """
+        if allow is None and deny is None and predicate is None:
+            raise ValueError('need an allow set, a deny set or a predicate')
+        self.client = client
+        self.allow = None if allow is None else frozenset(allow)
+        self.deny = None if deny is None else frozenset(deny)
+        self.predicate = predicate
+        self.cache_ttl = cache_ttl
+        self.rate = rate
+        self.concurrency = concurrency
+        self.max_kills = max_kills
+        self._cache = {}
+
+    def _allowed(self, names):
+        """
+            Those of names that predicate lets stay, asking it only
+            about the ones whose answer isn't cached.
+        """
+        now = time.monotonic()
+        allowed = set()
+        for name in names:
+            cached = self._cache.get(name)
+            if cached is None or cached[0] <= now:
+                cached = self._cache[name] = (now + self.cache_ttl, bool(self.predicate(name)))
+            if cached[1]:
+                allowed.add(name)
+        return allowed
+
+    def violators(self, users):
+        """
+            Which users of a getusers dict must go, as {target: (common
+            name, real address)}.  The target is what to kill: the
+            common name, or the real address where only that is denied.
+        """
+        names = users.keys()
+        doomed = set()
+        if self.allow is not None:
+            doomed |= names - self.allow
+        if self.deny is not None:
+            doomed |= names & self.deny
+        if self.predicate is not None:
+            undecided = names - doomed
+            doomed |= undecided - self._allowed(undecided)
+        targets = {name: users[name] for name in doomed}
+        if self.deny is not None:
+            by_address = {user[1]: name for name, user in users.items() if name not in doomed}
+            for address in by_address.keys() & self.deny:
+                targets[address] = users[by_address[address]]
+        return targets
+
+    def run(self, commit=False):
+        """
+            Fetch the users, work out the violators and kill them (only
+            pretending to, as kill does, without commit).  Returns a
+            ReconcileReport.
+        """
+        report = ReconcileReport(commit)
+        start = time.perf_counter()
+        users = self.client.getusers()
+        report.timings['fetch'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        report.violators = self.violators(users)
+        targets = sorted(report.violators)
+        if self.max_kills is not None:
+            report.skipped = targets[self.max_kills:]
+            targets = targets[:self.max_kills]
+        report.timings['evaluate'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        paced_from = time.monotonic()
+        for offset in range(0, len(targets), self.concurrency):
+            batch = targets[offset:offset + self.concurrency]
+            if self.rate:
+                wait = paced_from + offset / self.rate - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            try:
+                results = self.client.kill_many(batch, commit=commit)
+            except (socket.error, OSError) as err:
+                report.failed.update(dict.fromkeys(batch, repr(err)))
+                continue
+            if not commit:
+                report.skipped.extend(batch)
+                continue
+            for target in batch:
+                success, reply = results[target]
+                if success:
+                    report.killed.append(target)
+                else:
+                    report.failed[target] = reply
+        report.timings['kill'] = time.perf_counter() - start
+        return report
+
+
+class PoolResult(object):
+    """
+        What a VPNmgmtPool call came back with: results maps each
+        socket path that answered to its answer, and errors maps each
+        one that didn't to the exception (socket.timeout if it ran out
+        of time).
+    """
+    __slots__ = ('results', 'errors')
+
+    def __init__(self, results, errors):
+        self.results = results
+        self.errors = errors
+
+    def merged(self):
+        """
+            For dict-valued results (getusers): fold the per-server dicts
+            into one, {key: {socket path: value}}, so that for instance
+            each user maps to every server they're connected to.
+        """
+        merged = {}
+        for path, result in self.results.items():
+            for key, value in result.items():
+                merged.setdefault(key, {})[path] = value
+        return merged
+
+    def __repr__(self):
+        return f'PoolResult(results={self.results!r}, errors={self.errors!r})'
+
+
+class VPNmgmtPool(object):
+    """
+        One VPNmgmt per management socket, for hosts running several
+        openvpn daemons.  Each call runs against every server at once
+        (on a thread per server), so it costs the wall time of the
+        slowest server rather than the sum of them all, and returns a
+        PoolResult.  Connections are opened on first use and kept; one
+        that errors or times out is thrown away and reopened next time.
+    """
+    def __init__(self, socket_paths, timeout=10.0, password=None):
+        """
+            socket_paths: the management sockets to talk to.
+            timeout: default seconds to wait for all servers to answer.
+            password: for servers that ask for one.
+        """
+        self.password = password
+        self.clients = {path: VPNmgmt(path, password) for path in socket_paths}
+        self.timeout = timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(max(len(self.clients), 1))
+        self._connected = set()
+        # path -> future of a call that timed out and may still be running
+        self._busy = {}
+
+    def _reset(self, path):
+        """
+            Drop a connection that can no longer be trusted, and set up
+            a fresh one to be opened on next use.
+        """
+        self._connected.discard(path)
+        try:
+            self.clients[path].sock.close()
+        except (socket.error, OSError):  # pragma: no cover
+            pass
+        self.clients[path] = VPNmgmt(path, self.password)
+
+    def _call(self, path, method, args):
+        """
+            Run method(client, *args) for one server, connecting first
+            if need be.  Runs in a worker thread.
+        """
+        client = self.clients[path]
+        try:
+            if path not in self._connected:
+                client.connect()
+                self._connected.add(path)
+            return method(client, *args)
+        except (socket.error, OSError):
+            self._reset(path)
+            raise
+
+    def _run(self, method, args=(), timeout=None):
+        """
+            Call method(client, *args) against every server at once and
+            gather the answers into a PoolResult.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        futures = {}
+        errors = {}
+        for path in self.clients:
+            busy = self._busy.pop(path, None)
+            if busy is not None:
+                if not busy.done():
+                    self._busy[path] = busy
+                    errors[path] = socket.timeout('still busy with an earlier command')
+                    continue
+                # It finished eventually, but whatever it read is gone.
+                self._reset(path)
+            futures[self._executor.submit(self._call, path, method, args)] = path
+        done, not_done = concurrent.futures.wait(futures, timeout)
+        results = {}
+        for future in done:
+            path = futures[future]
+            if future.exception() is not None:
+                errors[path] = future.exception()
+            else:
+                results[path] = future.result()
+        for future in not_done:
+            path = futures[future]
+            self._busy[path] = future
+            errors[path] = socket.timeout(f'no answer within {timeout} seconds')
+        return PoolResult(results, errors)
+
+    def connect(self, timeout=None):
+        """
+            Open every connection that isn't open yet.  Results are None.
+        """
+        return self._run(lambda client: None, timeout=timeout)
+
+    def status(self, timeout=None):
+        """
+            Every server's status text.
+        """
+        return self._run(VPNmgmt.status, timeout=timeout)
+
+    def getusers(self, timeout=None):
+        """
+            Every server's getusers dict; use .merged() on the result
+            for one who-is-connected-where view.
+        """
+        return self._run(VPNmgmt.getusers, timeout=timeout)
+
+    def kill(self, user, commit=False, timeout=None):
+        """
+            Disconnect a user from every server.  Each result is what
+            VPNmgmt.kill returns for that server.
+        """
+        return self._run(VPNmgmt.kill, (user, commit), timeout=timeout)
+
+    def kill_many(self, users, commit=False, timeout=None):
+        """
+            Disconnect many users from every server, each server's kills
+            going out in one pipelined batch (see VPNmgmt.kill_many).
+        """
+        return self._run(VPNmgmt.kill_many, (list(users), commit), timeout=timeout)
 
     def disconnect(self):
+        """
+            Gracefully leave every connection, and stop the workers.
+        """
+        for path in list(self.clients):
+            if path in self._connected and path not in self._busy:
+                self.clients[path].disconnect()
+            else:
+                self.clients[path].sock.close()
+        self._connected.clear()
+        self._executor.shutdown(wait=False)
+
+
+class AsyncVPNmgmt(object):
+    """
+        asyncio flavor of VPNmgmt, with the same calls as coroutines.
+        Commands are pipelined: any number of them can be in flight on
+        the one connection, and a single reader task hands each reply
+        to its caller in the order the commands were written, so one
+        event loop can drive many management sockets at once.
+    """
+    # Seconds allowed for establishing the connection.
+    connect_timeout = 10.0
+    # Longest single line we will accept from the server.
+    line_limit = 1024 * 1024
+    # Most events we hold for events(); older ones drop.
+    event_backlog = 10000
+
+    def __init__(self, socket_path, password=None):
+        """
+            Record where the server is (as for VPNmgmt).  Nothing is
+            connected until connect() is awaited.
+        """
+        self.family, self.address = _management_address(socket_path)
+        self.socket_path = socket_path
+        self.password = password
+        self._reader = None
+        self._writer = None
+        self._pump_task = None
+        # (framing, future) for each command awaiting its reply, oldest first.
+        self._pending = collections.deque()
+        self._event_parser = EventParser()
+        self._event_queue = None
+        self.event_callbacks = []
+        self.subscriptions = []
+
+    async def connect(self):
+        """
+            Connect to the server's socket, log in if it asks for a
+            password, and start reading replies.  The welcome banner is
+            a '>' notification line, so it turns up as an INFO event.
+        """
+        if self.family == socket.AF_UNIX:
+            opening = asyncio.open_unix_connection(self.address, limit=self.line_limit)
+        else:
+            opening = asyncio.open_connection(*self.address, limit=self.line_limit)
+        self._reader, self._writer = await asyncio.wait_for(opening, self.connect_timeout)
+        if self.family != socket.AF_UNIX:
+            _tune_tcp(self._writer.get_extra_info('socket'))
+        self._event_queue = asyncio.Queue(self.event_backlog)
+        try:
+            await asyncio.wait_for(self._login(), self.connect_timeout)
+        except (ConnectionError, OSError, asyncio.TimeoutError):
+            self._writer.close()
+            self._writer = None
+            raise
+        self._pump_task = asyncio.ensure_future(self._pump())
+
+    async def _login(self):
+        """
+            Answer the password prompt, if the server opens with one.
+            Any other opening is the banner, which is passed on as a
+            notification.
+        """
+        start = b''
+        while len(start) < len(_PASSWORD_PROMPT) and _PASSWORD_PROMPT.startswith(start):
+            data = await self._reader.read(len(_PASSWORD_PROMPT) - len(start))
+            if not data:
+                break
+            start += data
+        if start != _PASSWORD_PROMPT:
+            if start and not start.endswith(b'\n'):
+                start += await self._reader.readline()
+            for line in start.splitlines():
+                if line.startswith(b'>'):
+                    self._notification(line)
+            return
+        if self.password is None:
+            raise PermissionError('the management interface wants a password')
+        self._writer.write(f'{self.password}\r\n'.encode('utf-8'))
+        await self._writer.drain()
+        if not VPNmgmt._success(await self._reader.readline()):
+            raise PermissionError('the management interface refused our password')
+
+    async def disconnect(self):
         """
             Gracefully leave the connection if possible.
         """
+        if self._writer is None:
+            return
         try:
-            self._send('quit')
-        except socket.error:
+            await self._send('quit')
+        except (ConnectionError, OSError):
             pass
+        self._writer.close()
         try:
-            self.sock.shutdown(socket.SHUT_RDWR)
-        except (socket.error, OSError):
+            await self._writer.wait_closed()
+        except (ConnectionError, OSError):
             pass
-        self.sock.close()
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            try:
+                await self._pump_task
+            except asyncio.CancelledError:
+                pass
+        self._fail_pending(ConnectionResetError('management connection closed'))
+        self._writer = None
 
-    def _send(self, command, stopon=None):
+    def _fail_pending(self, exc):
         """
-            Since the interactions with openvpn management are mostly
-            call-and-response, this is the internal call to go and do
-            exactly that.  Send a command, read back from the server
-            until it stops, or you hit something that you declare as
-            a stopping point.  Then, return that (sometimes multiline)
-            string to the caller.
-        """
-        if stopon is not None and not isinstance(stopon, bytes):
-            stopon = stopon.encode('utf-8')
-        self.sock.send(f'{command}\r\n'.encode('utf-8'))
-        data = b''
+            Error out every command still waiting on a reply.
+        """
+        while self._pending:
+            _framing, future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(exc)
+
+    async def _pump(self):
+        """
+            The one reader of the socket: gather lines into replies and
+            resolve the oldest waiting command with each one.
+        """
+        lines = []
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                if line.startswith(b'>'):
+                    # Real-time notification, not part of any reply.
+                    self._notification(line)
+                    continue
+                if not self._pending:
+                    continue
+                framing, future = self._pending[0]
+                lines.append(line)
+                if _reply_done(framing, len(lines) - 1, line, 0, len(line)):
+                    self._pending.popleft()
+                    if not future.done():
+                        future.set_result(b''.join(lines).decode('utf-8'))
+                    lines = []
+            # The server closed on us.  Like VPNmgmt, the command being
+            # answered gets whatever arrived; anything after it gets an error.
+            if lines and self._pending:
+                _framing, future = self._pending.popleft()
+                if not future.done():
+                    future.set_result(b''.join(lines).decode('utf-8'))
+            self._fail_pending(ConnectionResetError('management connection closed'))
+        except (ConnectionError, OSError, asyncio.LimitOverrunError, ValueError) as err:
+            self._fail_pending(err)
+        finally:
+            # Let anyone iterating events() know the stream has ended.
+            self._put_event(None)
+
+    def _notification(self, line):
+        """
+            Turn a notification line into an Event (once complete) and
+            hand it to the callbacks and the events() queue.
+        """
+        event = self._event_parser.feed(line)
+        if event is None:
+            return
+        for callback in self.event_callbacks:
+            callback(event)
+        self._put_event(event)
+
+    def _put_event(self, event):
+        """
+            Queue an event for events(), dropping the oldest if full.
+        """
+        if self._event_queue is None:
+            return
+        if self._event_queue.full():
+            self._event_queue.get_nowait()
+        self._event_queue.put_nowait(event)
+
+    async def subscribe(self, bytecount=None, state=False, log=False):
+        """
+            Ask for real-time notifications, as VPNmgmt.subscribe does.
+        """
+        commands = []
+        if bytecount:
+            commands.append(f'bytecount {int(bytecount)}')
+        if state:
+            commands.append('state on')
+        if log:
+            commands.append('log on')
+        replies = await self._send_many(commands)
+        for command in commands:
+            if command not in self.subscriptions:
+                self.subscriptions.append(command)
+        return dict(zip(commands, replies))
+
+    def add_event_callback(self, callback):
+        """
+            Have callback(event) called for every Event as it is read.
+        """
+        self.event_callbacks.append(callback)
+
+    async def events(self):
+        """
+            Async iterator over Events as they arrive, which ends when the
+            connection closes.  Commands can still be sent meanwhile;
+            their replies never show up here.
+        """
+        if self._event_queue is None:
+            return
         while True:
-            # keep on reading until hitting timeout, in case the server is
-            # being slow.  stopon is used to make this faster: you don't
-            # need to wait for timeout if you know you already have the data.
-            # Be careful that stopon doesn't match the data, though.
-            rbuf, _wbuf, _ebuf = select.select([self.sock], [], [], 1)
-            buf = ''
-            for filedesc in rbuf:
-                if filedesc == self.sock:
-                    buf = self.sock.recv(1024)
-                    data += buf
-            if buf == b'' or stopon is not None and data.find(stopon) != -1:
-                break
-        return data.decode('utf-8')
+            event = await self._event_queue.get()
+            if event is None:
+                return
+            yield event
 
-    @staticmethod
-    def _success(input_string):
+    async def _send(self, command):
         """
-            Indicates if the openvpn management server reports a
-            success (True) or failure (False) condition after
-            we run a command.
-            https://openvpn.net/community-resources/management-interface/
+            Write a command and wait for its reply.  Other commands may
+            be written before this one is answered.
         """
-        if not isinstance(input_string, bytes):
-            input_string = input_string.encode('utf-8')
-        if input_string.startswith(b'SUCCESS'):
-            return True
-        return False
+        if self._writer is None:
+            raise ConnectionError('not connected')
+        framing = reply_framing(command)
+        future = None
+        if framing != FRAME_NONE:
+            future = asyncio.get_running_loop().create_future()
+            self._pending.append((framing, future))
+        self._writer.write(f'{command}\r\n'.encode('utf-8'))
+        await self._writer.drain()
+        if future is None:
+            return ''
+        return await future
 
-    def status(self):
+    async def _send_many(self, commands):
         """
-            Return the status as reported by the openvpn server.
-            This will return status 2 (a comma delimited format)
-            This is just to make parsing easier.
+            Write many commands in one go and wait for all their replies.
         """
-        return self._send('status 2', 'END')
+        if self._writer is None:
+            raise ConnectionError('not connected')
+        loop = asyncio.get_running_loop()
+        futures = []
+        for command in commands:
+            future = loop.create_future()
+            framing = reply_framing(command)
+            if framing == FRAME_NONE:
+                future.set_result('')
+            else:
+                self._pending.append((framing, future))
+            futures.append(future)
+        self._writer.write(''.join(f'{command}\r\n' for command in commands).encode('utf-8'))
+        await self._writer.drain()
+        return await asyncio.gather(*futures)
 
-    def getusers(self):
+    async def status(self):
         """
-            Returns a dict of the users connected to the VPN:
-            {
-                username: [str username, str ipv4-client-address]
-            }
-            Note that we are using the strict definition of 'connected'
-            as folks in the 'ROUTING_TABLE' (fully established, have a
-            client IP), and not the 'CLIENT_LIST' (half-established,
-            without a client IP).  The reason for this is, there are
-            a lot of script kiddies who will be knocking on your front
-            door, and kicking them off when they're in half-established
-            just ends up causing noise.  You should deal with them via
-            some sort of blocklist instead of this script.  Our focus
-            is removing terminated users who have real connections.
+            Return the status as reported by the openvpn server,
+            in status 2 (comma delimited) format.
         """
-        data = self.status()
-        users = {}
-        if re.findall('^TITLE', data):
-            # version 2 or 3, the first thing is a TITLE header;
-            # We don't need multiline here.
-            matched_lines = re.findall(
-                r'^ROUTING_TABLE[,\t].+[,\t](.+)[,\t](\d+\.\d+\.\d+\.\d+\:\d+)[,\t]',
-                data, re.MULTILINE)
-            # These DO need multiline, since data is a stream and we're
-            # 'abusing' ^ by anchoring to newlines in the middle
-        else:
-            # version 1 or an error condition.
-            matched_lines = re.findall(
-                r',(.+),(\d+\.\d+\.\d+\.\d+\:\d+)',
-                data)
-        for matchset in matched_lines:
-            username = matchset[0]
-            if username == 'UNDEF':
-                # This is subtle so needs a lot of explaining.
-                #
-                # openvpn source code, src/openvpn/multi.c
-                # multi_print_status calls tls_common_name and if tls_multi is NULL / not fully
-                # established (which can happen due to deferred authentication and races between
-                # auth / negotiations and status delays), the username in ROUTING_TABLE can come
-                # out as 'UNDEF' briefly, usually "one iteration of a status file update."
-                #
-                # Since it's a hard-coded word in the source we're replicating that here and
-                # ignoring any UNDEF user, since it's not really a user.  This DOES mean that if
-                # you have a user with the certificate Common Name of literal string 'UNDEF'
-                # that we're going to suppress that they're connecting, but, you deserve to lose.
-                continue
-            # Pass along all the variables in matchset.
-            # This makes "field 1" here be "field 1" later.
-            users[username] = matchset
-        return users
+        return await self._send('status 2')
 
-    def kill(self, user, commit=False):
+    async def getusers(self):
         """
-            Disconnect a single user.  Does not check
-            if they were there or not.
-            Returns True/False depending on if the server
-            reports a success or not.
+            Returns a dict of the users connected to the VPN, exactly
+            as VPNmgmt.getusers does.
+        """
+        return _users_from_records(parse_status((await self.status()).splitlines()))
+
+    async def getstatus(self):
+        """
+            Return the server's status as a Status snapshot.
+        """
+        return Status(parse_status((await self.status()).splitlines()))
+
+    async def kill(self, user, commit=False):
+        """
+            Disconnect a single user, as VPNmgmt.kill does.
+            Returns (bool success, str server reply).
         """
         if commit:
-            ret = self._send(f'kill {user}', stopon='\r\n')
+            ret = await self._send(f'kill {user}')
         else:
-            # Send something useless, just to make testing
-            # behave a bit more like real life.
-            ret = self._send('version')
-        return (self._success(ret), ret)
+            ret = await self._send('version')
+        return (VPNmgmt._success(ret), ret)
+
+    async def client_auth(self, cid, kid, config=None):
+        """
+            Let a client that is waiting on --management-client-auth in,
+            optionally pushing it config lines.
+            Returns (bool success, str server reply).
+        """
+        if config:
+            command = '\r\n'.join([f'client-auth {cid} {kid}'] + list(config) + ['END'])
+        else:
+            command = f'client-auth-nt {cid} {kid}'
+        ret = await self._send(command)
+        return (VPNmgmt._success(ret), ret)
+
+    async def client_deny(self, cid, kid, reason, client_reason=None):
+        """
+            Turn away a client that is waiting on --management-client-auth.
+            reason goes to the server log; client_reason, if given, is
+            sent to the client.
+            Returns (bool success, str server reply).
+        """
+        command = f'client-deny {cid} {kid} {_quote(reason)}'
+        if client_reason is not None:
+            command += f' {_quote(client_reason)}'
+        ret = await self._send(command)
+        return (VPNmgmt._success(ret), ret)
+
+    async def kill_many(self, users, commit=False):
+        """
+            Disconnect many users in one round trip, as
+            VPNmgmt.kill_many does.
+        """
+        users = list(dict.fromkeys(users))
+        if not users:
+            return {}
+        if not commit:
+            ret = await self._send('version')
+            return {user: (VPNmgmt._success(ret), ret) for user in users}
+        replies = await self._send_many([f'kill {user}' for user in users])
+        return {user: (VPNmgmt._success(ret), ret) for user, ret in zip(users, replies)}
+
+
+class AuthDecision(object):
+    """
+        What a client-auth policy made of one client: let it in (with
+        config lines to push, if any), or turn it away with a reason
+        for the log and, optionally, one for the client.
+    """
+    __slots__ = ('allow', 'reason', 'client_reason', 'config')
+
+    def __init__(self, allow, reason=None, client_reason=None, config=None):
+        self.allow = allow
+        self.reason = reason
+        self.client_reason = client_reason
+        self.config = config
+
+    def __repr__(self):
+        return (f'AuthDecision({self.allow!r}, {self.reason!r}, '
+                f'{self.client_reason!r}, {self.config!r})')
+
+
+class ClientAuthHandler(object):
+    """
+        Answers the >CLIENT:CONNECT and >CLIENT:REAUTH requests of a
+        server running --management-client-auth, on an AsyncVPNmgmt.
+        Each request (an Event, with the client's details in env) goes
+        to policy, and its answer goes back as client-auth-nt/client-auth
+        or client-deny the moment it is ready, so a storm of reconnects
+        is decided many at a time rather than one by one.
+
+        policy(event) returns True, False or an AuthDecision.  It may be
+        a coroutine function, run on the event loop, or a plain function,
+        run on a pool of threads.  Either way at most `workers` decisions
+        are in progress at once; the rest wait in a queue.  A policy that
+        raises denies the client (fail closed) and counts as an error.
+    """
+    # Requests that need an answer; the rest only inform.
+    _REQUESTS = frozenset(['CLIENT:CONNECT', 'CLIENT:REAUTH'])
+    # Decision latencies kept for stats().
+    latency_samples = 10000
+
+    def __init__(self, client, policy, workers=16, deny_reason='denied by policy'):
+        """
+            client: a connected AsyncVPNmgmt.
+            policy: see above.
+            workers: the most decisions in progress at once.
+            deny_reason: the log reason when the policy just says False.
+        """
+        self.client = client
+        self.policy = policy
+        self.workers = workers
+        self.deny_reason = deny_reason
+        self._queue = None
+        self._tasks = []
+        self._executor = None
+        self.in_flight = 0
+        self.max_depth = 0
+        self.allowed = 0
+        self.denied = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=self.latency_samples)
+
+    def start(self):
+        """
+            Start answering requests.  Call from within the event loop.
+        """
+        self._queue = asyncio.Queue()
+        if not asyncio.iscoroutinefunction(self.policy):
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix='openvpn-client-auth')
+        self._tasks = [asyncio.ensure_future(self._worker()) for _count in range(self.workers)]
+        self.client.add_event_callback(self._on_event)
+
+    async def stop(self):
+        """
+            Stop answering requests.  Ones still queued are left for the
+            server to time out.
+        """
+        if self._on_event in self.client.event_callbacks:
+            self.client.event_callbacks.remove(self._on_event)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _on_event(self, event):
+        """
+            Event callback: queue the requests, noting when they came.
+        """
+        if event.kind in self._REQUESTS and self._queue is not None:
+            self._queue.put_nowait((time.monotonic(), event))
+            self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    async def _decide(self, event):
+        """
+            Run the policy on one request, as an AuthDecision.
+        """
+        if self._executor is None:
+            decision = await self.policy(event)
+        else:
+            loop = asyncio.get_running_loop()
+            decision = await loop.run_in_executor(self._executor, self.policy, event)
+        if not isinstance(decision, AuthDecision):
+            decision = AuthDecision(bool(decision))
+        return decision
+
+    async def _worker(self):
+        """
+            Take requests off the queue, decide them, and answer.
+        """
+        while True:
+            arrived, event = await self._queue.get()
+            self.in_flight += 1
+            try:
+                await self._answer(event)
+            except (ConnectionError, OSError):
+                self.errors += 1
+            finally:
+                self.in_flight -= 1
+                self.latencies.append(time.monotonic() - arrived)
+
+    async def _answer(self, event):
+        """
+            Decide one request and send the verdict.
+        """
+        cid, kid = event.args[0], event.args[1]
+        try:
+            decision = await self._decide(event)
+        except Exception:  # pylint: disable=broad-except
+            self.errors += 1
+            decision = AuthDecision(False, 'client-auth policy failed')
+        if decision.allow:
+            self.allowed += 1
+            await self.client.client_auth(cid, kid, decision.config)
+        else:
+            self.denied += 1
+            await self.client.client_deny(cid, kid, decision.reason or self.deny_reason,
+                                          decision.client_reason)
+
+    def stats(self):
+        """
+            How it is going: queue depth now and at most, decisions in
+            progress, counts, and decision latency (from the request
+            arriving to its answer being acknowledged, in seconds) as
+            p50/p99/max over the latest samples.
+        """
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            ''' The given fraction's sample, or None without any '''
+            if not latencies:
+                return None
+            return latencies[min(int(fraction * len(latencies)), len(latencies) - 1)]
+        return {
+            'depth': self._queue.qsize() if self._queue is not None else 0,
+            'max_depth': self.max_depth,
+            'in_flight': self.in_flight,
+            'allowed': self.allowed,
+            'denied': self.denied,
+            'errors': self.errors,
+            'latency_p50': percentile(0.50),
+            'latency_p99': percentile(0.99),
+            'latency_max': latencies[-1] if latencies else None,
+        }
+
+
+# kill_many batch size for 'openvpn-mgmt kill', so results stream out
+# while a long list from stdin is still being worked through.
+_CLI_KILL_BATCH = 100
+
+
+def _cli_status(client, args, emit):
+    """
+        openvpn-mgmt status: every Client and Route record, as parsed.
+    """
+    for record in client.iter_status(args.version, args.timeout):
+        emit({'type': 'client' if isinstance(record, Client) else 'route',
+              **record._asdict()})
+    return 0
+
+
+def _cli_users(client, args, emit):
+    """
+        openvpn-mgmt users: the connected users, one row per session.
+    """
+    for username, real_address in _iter_users(client.iter_status(timeout=args.timeout)):
+        emit({'common_name': username, 'real_address': real_address})
+    return 0
+
+
+def _cli_kill(client, args, emit):
+    """
+        openvpn-mgmt kill: disconnect the users named (or read from
+        stdin, given '-'), a batch at a time.  Exits 1 if any kill
+        failed.
+    """
+    users = args.users
+    if users == ['-']:
+        users = (line.strip() for line in sys.stdin)
+    users = (user for user in users if user)
+    status = 0
+    while True:
+        batch = list(itertools.islice(users, _CLI_KILL_BATCH))
+        if not batch:
+            return status
+        results = client.kill_many(batch, commit=args.commit, timeout=args.timeout)
+        for user, (success, reply) in results.items():
+            emit({'user': user, 'success': success, 'commit': args.commit,
+                  'reply': reply.strip()})
+            # A dry run's 'version' reply is never a SUCCESS; only real
+            # kills can fail.
+            if args.commit and not success:
+                status = 1
+
+
+def _cli_watch(client, args, emit):
+    """
+        openvpn-mgmt watch: a row as each user connects or disconnects,
+        until the server goes away.  Client notifications (from servers
+        running --management-client-auth) make that immediate; failing
+        those, a status every args.interval seconds catches the changes.
+    """
+    client.track_users(args.interval)
+    users, _added, _removed = client.getusers_changes()
+    if args.initial:
+        for name in sorted(users):
+            emit({'event': 'connect', 'common_name': name, 'real_address': users[name][1],
+                  'time': int(time.time())}, flush=True)
+    while client.reader.read_notifications(args.interval):
+        previous = users
+        users, added, removed = client.getusers_changes()
+        now = int(time.time())
+        for name in sorted(removed):
+            emit({'event': 'disconnect', 'common_name': name,
+                  'real_address': previous[name][1], 'time': now}, flush=True)
+        for name in sorted(added):
+            emit({'event': 'connect', 'common_name': name,
+                  'real_address': users[name][1], 'time': now}, flush=True)
+    return 0
+
+
+_CLI_COMMANDS = {'status': _cli_status, 'users': _cli_users,
+                 'kill': _cli_kill, 'watch': _cli_watch}
+
+
+def main(argv=None):
+    """
+        The openvpn-mgmt command.  Results go to stdout as one JSON
+        object per line, written as the reply is parsed rather than
+        after it is all in.  Returns the exit status: 0, 1 if a kill
+        failed, 2 if the server couldn't be talked to.
+    """
+    # Imported here to keep the module quick to load for everyone else.
+    import argparse  # pylint: disable=import-outside-toplevel
+    import json  # pylint: disable=import-outside-toplevel
+    parser = argparse.ArgumentParser(
+        prog='openvpn-mgmt', description='Query an openvpn management interface.')
+    parser.add_argument('-s', '--socket', required=True,
+                        help='absolute path of the unix socket, or host:port')
+    parser.add_argument('--password-file',
+                        help="file whose first line is the interface's password")
+    parser.add_argument('-t', '--timeout', type=float,
+                        help='seconds each command may take')
+    commands = parser.add_subparsers(dest='command', required=True)
+    status = commands.add_parser('status', help='the client and routing tables')
+    status.add_argument('--version', type=int, choices=(1, 2, 3), default=2,
+                        help='status format to ask the server for')
+    commands.add_parser('users', help='connected users, one row per session')
+    kill = commands.add_parser('kill', help='disconnect users')
+    kill.add_argument('users', nargs='+', metavar='USER',
+                      help="common name or ip:port; '-' reads them from stdin")
+    kill.add_argument('--commit', action='store_true',
+                      help='really kill them; without this it is a dry run')
+    watch = commands.add_parser('watch', help='users connecting and disconnecting')
+    watch.add_argument('--interval', type=float, default=60.0,
+                       help='seconds between full status checks')
+    watch.add_argument('--initial', action='store_true',
+                       help='start with a connect row for everyone already there')
+    args = parser.parse_args(argv)
+
+    password = None
+    if args.password_file:
+        with open(args.password_file, encoding='utf-8') as handle:
+            password = handle.readline().rstrip('\r\n')
+    try:
+        client = VPNmgmt(args.socket, password)
+    except ValueError as err:
+        parser.error(str(err))
+    out = sys.stdout
+
+    def emit(row, flush=False):
+        ''' Write one row; watch flushes each so tails see it at once '''
+        out.write(json.dumps(row, separators=(',', ':')) + '\n')
+        if flush:
+            out.flush()
+    try:
+        client.connect(args.timeout)
+    except OSError as err:
+        print(f'openvpn-mgmt: cannot connect to {args.socket}: {err}', file=sys.stderr)
+        return 2
+    try:
+        status = _CLI_COMMANDS[args.command](client, args, emit)
+        out.flush()
+        return status
+    except BrokenPipeError:
+        # Whoever reads our output (head, say) has had enough.  Point
+        # stdout somewhere harmless so the flush at exit doesn't fail too.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), out.fileno())
+        return 0
+    except KeyboardInterrupt:
+        return 130
+    except OSError as err:
+        print(f'openvpn-mgmt: {err}', file=sys.stderr)
+        return 2
+    finally:
+        client.disconnect()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
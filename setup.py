@@ -45,4 +45,7 @@ setup(
     long_description=open('README.md').read(),
     license='MPL',
     py_modules=[NAME],
+    entry_points={
+        'console_scripts': ['openvpn-mgmt = openvpn_management:main'],
+    },
 )
@@ -0,0 +1,359 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+   A simulated openvpn management server, for tests and benchmarks.
+
+   It listens on a unix socket, keeps a table of (fake) clients, and
+   speaks enough of the management protocol to exercise the client at
+   production scale: status 1/2/3 for any number of clients, kill,
+   client-kill, bytecount, load-stats, pid, version, log/state/echo and
+   quit, plus real-time >CLIENT: notifications.  Knobs make it slow,
+   chatty or unreliable on purpose:
+
+       latency            seconds to sit on each command before answering
+       chunk_size         split every write into pieces this big ...
+       write_delay        ... and sleep this long between the pieces
+       disconnect_after   hang up after this many commands
+"""
+import os
+import select
+import socket
+import socketserver
+import threading
+import time
+
+
+BANNER = b">INFO:OpenVPN Management Interface Version 1 -- type 'help' for more info\r\n"
+TITLE = 'OpenVPN 2.4.6 x86_64-redhat-linux-gnu [SSL (OpenSSL)] [LZO] [LZ4] [EPOLL] [MH/PKTINFO] [AEAD]'
+EPOCH = 1537893169
+
+
+class FakeClient(object):
+    '''
+        One simulated VPN client.
+    '''
+    __slots__ = ('cid', 'common_name', 'real_address', 'virtual_address',
+                 'bytes_received', 'bytes_sent', 'connected_since')
+
+    def __init__(self, cid, common_name=None):
+        self.cid = cid
+        self.common_name = common_name or f'user{cid}@company.com'
+        self.real_address = f'10.{(cid >> 16) & 255}.{(cid >> 8) & 255}.{cid & 255}:{1024 + cid % 60000}'
+        self.virtual_address = f'172.{16 + ((cid >> 16) & 15)}.{(cid >> 8) & 255}.{cid & 255}'
+        self.bytes_received = 1000 * cid
+        self.bytes_sent = 3000 * cid
+        self.connected_since = EPOCH + cid
+
+    @property
+    def ip_port(self):
+        ''' The real address, split into (ip, port) '''
+        ip_address, _sep, port = self.real_address.rpartition(':')
+        return ip_address, port
+
+
+class ManagementHandler(socketserver.BaseRequestHandler):
+    '''
+        One management connection.  Commands are read a line at a time;
+        notifications from other threads are written under a lock so
+        they never land in the middle of a reply.
+    '''
+    def setup(self):
+        self.fake = self.server.fake
+        self.lock = threading.Lock()
+        self.bytecount = 0
+        self.next_bytecount = None
+        self.realtime = set()
+        self.fake.connections.add(self)
+
+    def finish(self):
+        self.fake.connections.discard(self)
+
+    def write(self, data):
+        ''' Send data, in chunks and slowly if we've been told to be slow '''
+        chunk_size = self.fake.chunk_size
+        with self.lock:
+            if not chunk_size:
+                self.request.sendall(data)
+                return
+            for start in range(0, len(data), chunk_size):
+                self.request.sendall(data[start:start + chunk_size])
+                if self.fake.write_delay:
+                    time.sleep(self.fake.write_delay)
+
+    def handle(self):
+        self.write(self.fake.greeting())
+        buf = b''
+        commands = 0
+        while True:
+            timeout = None
+            if self.next_bytecount is not None:
+                timeout = max(self.next_bytecount - time.monotonic(), 0)
+            readable, _w, _e = select.select([self.request], [], [], timeout)
+            if not readable:
+                self.write(self.fake.bytecount_lines())
+                self.next_bytecount = time.monotonic() + self.bytecount
+                continue
+            try:
+                data = self.request.recv(65536)
+            except (ConnectionError, OSError):
+                return
+            if not data:
+                return
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                command = line.strip().decode('utf-8', 'replace')
+                if not command:
+                    continue
+                if self.fake.latency:
+                    time.sleep(self.fake.latency)
+                if command == 'quit' or command == 'exit':
+                    return
+                self.write(self.fake.answer(self, command))
+                commands += 1
+                if self.fake.disconnect_after is not None and commands >= self.fake.disconnect_after:
+                    return
+
+
+class _Listener(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    ''' Threaded unix socket server for the fake '''
+    daemon_threads = True
+    block_on_close = False
+
+
+class FakeManagementServer(object):
+    '''
+        Simulated openvpn management server.  Use start() and stop(),
+        and add_client()/remove_client() to make clients come and go
+        (with >CLIENT: notifications) while a client is connected.
+    '''
+    def __init__(self, path, clients=0, status_version='2.4', client_notifications=True,
+                 latency=0.0, chunk_size=None, write_delay=0.0, disconnect_after=None):
+        self.path = path
+        self.status_version = status_version
+        self.client_notifications = client_notifications
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.write_delay = write_delay
+        self.disconnect_after = disconnect_after
+        self.clients = {}
+        self.connections = set()
+        self.commands = []
+        self.log_history = [(EPOCH, 'I', 'Initialization Sequence Completed')]
+        self.state_history = [(EPOCH, 'CONNECTED', 'SUCCESS', '10.8.0.1', '')]
+        self._next_cid = 0
+        self._lock = threading.Lock()
+        self._status_cache = {}
+        self._listener = None
+        for _count in range(clients):
+            self.add_client(notify=False)
+
+    def start(self):
+        ''' Listen on the socket, in a background thread '''
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._listener = _Listener(self.path, ManagementHandler)
+        self._listener.fake = self
+        thread = threading.Thread(target=self._listener.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        ''' Stop listening and hang up on everyone '''
+        if self._listener is not None:
+            self._listener.shutdown()
+            self._listener.server_close()
+            self._listener = None
+        for connection in list(self.connections):
+            try:
+                connection.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # --- the client table
+
+    def add_client(self, common_name=None, notify=True):
+        ''' Connect a new simulated client; returns its client id '''
+        with self._lock:
+            cid = self._next_cid
+            self._next_cid += 1
+            client = FakeClient(cid, common_name)
+            self.clients[cid] = client
+            self._status_cache.clear()
+        if notify and self.client_notifications:
+            self.broadcast(self._client_block('ESTABLISHED', client))
+        return cid
+
+    def remove_client(self, cid, notify=True):
+        ''' Disconnect a simulated client; returns it, or None '''
+        with self._lock:
+            client = self.clients.pop(cid, None)
+            self._status_cache.clear()
+        if client is not None and notify and self.client_notifications:
+            self.broadcast(self._client_block('DISCONNECT', client))
+        return client
+
+    def broadcast(self, data):
+        ''' Send a notification to every connected management client '''
+        for connection in list(self.connections):
+            try:
+                connection.write(data)
+            except OSError:
+                pass
+
+    def log(self, message, flags='I'):
+        ''' Add a line to the log history, and send it to anyone with 'log on' '''
+        entry = (int(time.time()), flags, message)
+        self.log_history.append(entry)
+        line = ('>LOG:' + ','.join(str(field) for field in entry) + '\r\n').encode('utf-8')
+        for connection in list(self.connections):
+            if 'log' in connection.realtime:
+                connection.write(line)
+
+    @staticmethod
+    def _client_block(kind, client):
+        ''' A >CLIENT: notification with its ENV block '''
+        ip_address, port = client.ip_port
+        return (f'>CLIENT:{kind},{client.cid}\r\n'
+                f'>CLIENT:ENV,common_name={client.common_name}\r\n'
+                f'>CLIENT:ENV,trusted_ip={ip_address}\r\n'
+                f'>CLIENT:ENV,trusted_port={port}\r\n'
+                f'>CLIENT:ENV,ifconfig_pool_remote_ip={client.virtual_address}\r\n'
+                f'>CLIENT:ENV,END\r\n').encode('utf-8')
+
+    # --- replies
+
+    def greeting(self):
+        ''' What a new connection is sent first '''
+        return BANNER
+
+    def bytecount_lines(self):
+        ''' One >BYTECOUNT_CLI line per client '''
+        with self._lock:
+            clients = list(self.clients.values())
+        return ''.join(f'>BYTECOUNT_CLI:{client.cid},{client.bytes_received},{client.bytes_sent}\r\n'
+                       for client in clients).encode('utf-8')
+
+    def status(self, version):
+        ''' The whole reply to 'status <version>', cached until the table changes '''
+        with self._lock:
+            cached = self._status_cache.get(version)
+            if cached is None:
+                cached = self._status_cache[version] = self._render_status(version)
+            return cached
+
+    def _render_status(self, version):
+        ''' Build a status reply, in openvpn's own layout '''
+        clients = sorted(self.clients.values(), key=lambda client: client.cid)
+        stamp = time.strftime('%a %b %d %H:%M:%S %Y', time.gmtime(EPOCH))
+        if version == 1:
+            lines = ['OpenVPN CLIENT LIST', f'Updated,{stamp}',
+                     'Common Name,Real Address,Bytes Received,Bytes Sent,Connected Since']
+            lines += [f'{c.common_name},{c.real_address},{c.bytes_received},{c.bytes_sent},{stamp}'
+                      for c in clients]
+            lines += ['ROUTING TABLE', 'Virtual Address,Common Name,Real Address,Last Ref']
+            lines += [f'{c.virtual_address},{c.common_name},{c.real_address},{stamp}' for c in clients]
+            lines += ['GLOBAL STATS', 'Max bcast/mcast queue length,0', 'END']
+        else:
+            sep = '\t' if version == 3 else ','
+            client_columns = ['Common Name', 'Real Address', 'Virtual Address', 'Virtual IPv6 Address',
+                              'Bytes Received', 'Bytes Sent', 'Connected Since', 'Connected Since (time_t)',
+                              'Username', 'Client ID', 'Peer ID']
+            if self.status_version >= '2.5':
+                client_columns.append('Data Channel Cipher')
+            lines = [sep.join(['TITLE', TITLE.replace('2.4.6', self.status_version + '.0')]),
+                     sep.join(['TIME', stamp, str(EPOCH)]),
+                     sep.join(['HEADER', 'CLIENT_LIST'] + client_columns)]
+            for c in clients:
+                row = ['CLIENT_LIST', c.common_name, c.real_address, c.virtual_address, '',
+                       str(c.bytes_received), str(c.bytes_sent), stamp, str(c.connected_since),
+                       c.common_name, str(c.cid), str(c.cid % 256)]
+                if self.status_version >= '2.5':
+                    row.append('AES-256-GCM')
+                lines.append(sep.join(row))
+            lines.append(sep.join(['HEADER', 'ROUTING_TABLE', 'Virtual Address', 'Common Name',
+                                   'Real Address', 'Last Ref', 'Last Ref (time_t)']))
+            lines += [sep.join(['ROUTING_TABLE', c.virtual_address, c.common_name, c.real_address,
+                                stamp, str(EPOCH)]) for c in clients]
+            lines += [sep.join(['GLOBAL_STATS', 'Max bcast/mcast queue length', '0']), 'END']
+        return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+    def _history(self, connection, kind, history, args):
+        ''' The log/state/echo commands: on, off, all, N, or 'on all' '''
+        reply = ''
+        for arg in args:
+            if arg in ('on', 'off'):
+                if arg == 'on':
+                    connection.realtime.add(kind)
+                else:
+                    connection.realtime.discard(kind)
+                reply += f'SUCCESS: real-time {kind} notification set to {arg.upper()}\r\n'
+            elif arg == 'all' or arg.isdigit():
+                entries = history if arg == 'all' else history[-int(arg):]
+                reply += ''.join(','.join(str(field) for field in entry) + '\r\n' for entry in entries)
+                reply += 'END\r\n'
+            else:
+                reply += f"ERROR: {kind} parameter must be 'on' or 'off' or some number n or 'all'\r\n"
+        return reply
+
+    def answer(self, connection, command):
+        ''' The reply (bytes) to one command line '''
+        self.commands.append(command)
+        words = command.split()
+        verb, args = words[0].lower(), words[1:]
+        if verb == 'status':
+            version = int(args[0]) if args and args[0].isdigit() else 1
+            if version not in (1, 2, 3):
+                return b'ERROR: status command failed\r\n'
+            return self.status(version)
+        if verb == 'kill' and args:
+            return self._kill(command.split(None, 1)[1]).encode('utf-8')
+        if verb == 'client-kill' and args and args[0].isdigit():
+            if self.remove_client(int(args[0])) is None:
+                return b'ERROR: client-kill command failed\r\n'
+            return b'SUCCESS: client-kill command succeeded\r\n'
+        if verb == 'bytecount' and args and args[0].isdigit():
+            connection.bytecount = int(args[0])
+            connection.next_bytecount = time.monotonic() + connection.bytecount if connection.bytecount else None
+            return b'SUCCESS: bytecount interval changed\r\n'
+        if verb == 'load-stats':
+            with self._lock:
+                clients = list(self.clients.values())
+            return (f'SUCCESS: nclients={len(clients)},'
+                    f'bytesin={sum(c.bytes_received for c in clients)},'
+                    f'bytesout={sum(c.bytes_sent for c in clients)}\r\n').encode('utf-8')
+        if verb == 'pid':
+            return f'SUCCESS: pid={os.getpid()}\r\n'.encode('utf-8')
+        if verb == 'version':
+            return (f'OpenVPN Version: {TITLE}\r\nManagement Version: 1\r\nEND\r\n').encode('utf-8')
+        if verb in ('log', 'state', 'echo') and args:
+            history = {'log': self.log_history, 'state': self.state_history, 'echo': []}[verb]
+            return self._history(connection, verb, history, args).encode('utf-8')
+        if verb == 'help':
+            return b'Management Interface for OpenVPN (fake)\r\nCommands:\r\nEND\r\n'
+        return b"ERROR: unknown command, enter 'help' for more options\r\n"
+
+    def _kill(self, target):
+        ''' kill by common name, or by ip:port '''
+        with self._lock:
+            matches = [client for client in self.clients.values()
+                       if target in (client.common_name, client.real_address)]
+        for client in matches:
+            self.remove_client(client.cid)
+        if ':' in target:
+            if matches:
+                return f'SUCCESS: {len(matches)} client(s) at address {target} killed\r\n'
+            return f'ERROR: client(s) at address {target} not found\r\n'
+        if matches:
+            return f"SUCCESS: common name '{target}' found, {len(matches)} client(s) killed\r\n"
+        return f"ERROR: common name '{target}' not found\r\n"
@@ -0,0 +1,251 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+   This tests the asyncio client against a simulated openvpn management socket
+"""
+import asyncio
+import os
+import time
+import unittest
+import test.context  # pylint: disable=unused-import
+from openvpn_management import AsyncVPNmgmt, AuthDecision, ClientAuthHandler
+
+
+UNIX_SOCKET_FILENAME = '/tmp/good-test-path-async'  # nosec hardcoded_tmp_directory
+STATUS_2 = (b'TITLE,OpenVPN 2.4.6 x86_64-redhat-linux-gnu\r\n'
+            b'TIME,Tue Sep 25 22:45:07 2018,1537915507\r\n'
+            b'HEADER,ROUTING_TABLE,Virtual Address,Common Name,Real Address,Last Ref,Last Ref (time_t)\r\n'
+            b'ROUTING_TABLE,10.48.238.4,person2@company.com,1.2.3.4:49195,Tue Sep 25 22:45:04 2018,1537915504\r\n'
+            b'ROUTING_TABLE,10.48.238.2,person3@company.com,5.6.7.8:33874,Tue Sep 25 22:45:05 2018,1537915505\r\n'
+            b'GLOBAL_STATS,Max bcast/mcast queue length,0\r\n'
+            b'END\r\n')
+
+
+async def fake_server(reader, writer):
+    '''
+        Simulate an openvpn management server: answer each command line
+        in order, and only after a delay, so that clients pile commands up.
+    '''
+    writer.write(b">INFO:OpenVPN Management Interface Version 1 -- type 'help' for more info\r\n")
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        command = line.strip().decode('utf-8')
+        await asyncio.sleep(0.01)
+        if command == 'quit':
+            break
+        if command == 'status 2':
+            writer.write(STATUS_2)
+        elif command == 'version':
+            writer.write(b'OpenVPN Version: OpenVPN 2.4.6\r\nManagement Version: 1\r\nEND\r\n')
+        elif command.startswith('kill person'):
+            writer.write(f"SUCCESS: common name '{command[5:]}' found, 1 client(s) killed\r\n".encode('utf-8'))
+        else:
+            # Notifications can land between replies; they must be ignored.
+            writer.write(b'>BYTECOUNT_CLI:1,2,3\r\n')
+            writer.write(f"ERROR: common name '{command[5:]}' not found\r\n".encode('utf-8'))
+        await writer.drain()
+    writer.close()
+
+
+def auth_server(clients, answers):
+    '''
+        Simulate a --management-client-auth server that has a crowd of
+        clients waiting on it: announce them all, then note the
+        client-auth/client-deny answers.
+    '''
+    async def serve(reader, writer):
+        writer.write(b">INFO:OpenVPN Management Interface Version 1 -- type 'help' for more info\r\n")
+        for cid in range(clients):
+            writer.write(f'>CLIENT:CONNECT,{cid},0\r\n'
+                         f'>CLIENT:ENV,common_name=person{cid}@company.com\r\n'
+                         f'>CLIENT:ENV,untrusted_ip=1.2.3.{cid}\r\n'
+                         f'>CLIENT:ENV,END\r\n'.encode('utf-8'))
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.strip().decode('utf-8')
+            if command == 'quit':
+                break
+            answers.append(command)
+            if command.startswith('client-auth '):
+                # The config block runs to END before the one answer.
+                while command != 'END':
+                    command = (await reader.readline()).strip().decode('utf-8')
+                    answers.append(command)
+            writer.write(b'SUCCESS: client-auth command succeeded\r\n')
+            await writer.drain()
+        writer.close()
+    return serve
+
+
+class TestAsyncVPNmgmt(unittest.IsolatedAsyncioTestCase):
+    """ Class of tests """
+
+    async def asyncSetUp(self):
+        """ Preparing test rig """
+        if os.path.exists(UNIX_SOCKET_FILENAME):
+            os.unlink(UNIX_SOCKET_FILENAME)
+        self.server = await asyncio.start_unix_server(fake_server, UNIX_SOCKET_FILENAME)
+        self.library = AsyncVPNmgmt(UNIX_SOCKET_FILENAME)
+
+    async def asyncTearDown(self):
+        """ Cleaning test rig """
+        await self.library.disconnect()
+        self.server.close()
+        await self.server.wait_closed()
+        os.unlink(UNIX_SOCKET_FILENAME)
+
+    def test_00_badsetup(self):
+        """ Only absolute paths are accepted """
+        with self.assertRaises(ValueError):
+            AsyncVPNmgmt('not-a-path')
+
+    async def test_01_getusers(self):
+        """ Verify that we can fetch and parse users """
+        await self.library.connect()
+        users = await self.library.getusers()
+        self.assertEqual(sorted(users), ['person2@company.com', 'person3@company.com'])
+
+    async def test_02_pipelined(self):
+        """
+            Many commands in flight at once each get their own reply,
+            in the order they were sent.
+        """
+        await self.library.connect()
+        names = [f'person{i}' if i % 2 else f'nobody{i}' for i in range(50)]
+        results = await asyncio.gather(*[self.library.kill(name, commit=True) for name in names])
+        for name, (success, reply) in zip(names, results):
+            self.assertEqual(success, name.startswith('person'))
+            self.assertIn(f"'{name}'", reply)
+
+    async def test_03_kill_many(self):
+        """ A batch kill comes back as a per-user map """
+        await self.library.connect()
+        results = await self.library.kill_many(['person1', 'nobody', 'person2'], commit=True)
+        self.assertEqual(list(results), ['person1', 'nobody', 'person2'])
+        self.assertEqual([success for success, _reply in results.values()], [True, False, True])
+
+    async def test_04_dryrun_kill(self):
+        """ A non-commit kill only asks for the version """
+        await self.library.connect()
+        success, reply = await self.library.kill('person1', commit=False)
+        self.assertFalse(success)
+        self.assertTrue(reply.endswith('END\r\n'))
+
+    async def test_05_events(self):
+        """ Notifications between replies come out of events() """
+        await self.library.connect()
+        await self.library.kill('nobody', commit=True)
+        events = self.library.events()
+        event = await asyncio.wait_for(events.__anext__(), 1)
+        self.assertEqual(event.kind, 'INFO', 'the welcome banner is the first event')
+        event = await asyncio.wait_for(events.__anext__(), 1)
+        self.assertEqual((event.kind, event.client_id), ('BYTECOUNT_CLI', 1))
+        await events.aclose()
+
+    async def test_06_server_gone(self):
+        """ Commands on a closed connection raise rather than hang """
+        await self.library.connect()
+        await self.library.disconnect()
+        with self.assertRaises(ConnectionError):
+            await self.library.status()
+
+    async def test_07_tcp_password(self):
+        """ A TCP server that wants a password gets it """
+        async def serve(reader, writer):
+            ''' Ask for the password, then answer one pid '''
+            writer.write(b'ENTER PASSWORD:')
+            if (await reader.readline()).strip() != b'sekrit':
+                writer.write(b'ERROR: bad password\r\n')
+            else:
+                writer.write(b'SUCCESS: password is correct\r\n>INFO:OpenVPN Management Interface\r\n')
+                await reader.readline()
+                writer.write(b'SUCCESS: pid=42\r\n')
+            await writer.drain()
+            writer.close()
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        address = f"127.0.0.1:{server.sockets[0].getsockname()[1]}"
+        library = AsyncVPNmgmt(address, password='sekrit')
+        await library.connect()
+        self.assertEqual(await library._send('pid'), 'SUCCESS: pid=42\r\n')
+        event = await asyncio.wait_for(library.events().__anext__(), 1)
+        self.assertEqual(event.kind, 'INFO')
+        await library.disconnect()
+        with self.assertRaises(PermissionError):
+            await AsyncVPNmgmt(address, password='wrong').connect()
+        server.close()
+        await server.wait_closed()
+
+
+class TestClientAuthHandler(unittest.IsolatedAsyncioTestCase):
+    """ Class of tests """
+
+    async def asyncSetUp(self):
+        """ Preparing test rig """
+        if os.path.exists(UNIX_SOCKET_FILENAME):
+            os.unlink(UNIX_SOCKET_FILENAME)
+        self.answers = []
+        self.server = await asyncio.start_unix_server(auth_server(20, self.answers),
+                                                      UNIX_SOCKET_FILENAME)
+        self.library = AsyncVPNmgmt(UNIX_SOCKET_FILENAME)
+
+    async def asyncTearDown(self):
+        """ Cleaning test rig """
+        await self.library.disconnect()
+        self.server.close()
+        await self.server.wait_closed()
+        os.unlink(UNIX_SOCKET_FILENAME)
+
+    async def wait_for_answers(self, handler, count):
+        """ Wait until the handler has answered count requests """
+        for _count in range(200):
+            if handler.allowed + handler.denied >= count and not handler.in_flight:
+                return
+            await asyncio.sleep(0.01)
+        self.fail(f'only {handler.allowed + handler.denied} of {count} answered')
+
+    async def test_01_thread_policy(self):
+        """ A slow plain policy is run many at a time, off the loop """
+        def policy(event):
+            ''' Take a while, let in the even-numbered clients '''
+            time.sleep(0.1)
+            return int(event.env['common_name'][6:].split('@')[0]) % 2 == 0
+        handler = ClientAuthHandler(self.library, policy, workers=10)
+        await self.library.connect()
+        handler.start()
+        start = time.monotonic()
+        await self.wait_for_answers(handler, 20)
+        self.assertLess(time.monotonic() - start, 1, 'decisions were not made in parallel')
+        await handler.stop()
+        self.assertEqual(sorted(self.answers)[:2], ['client-auth-nt 0 0', 'client-auth-nt 10 0'])
+        self.assertIn('client-deny 1 0 "denied by policy"', self.answers)
+        stats = handler.stats()
+        self.assertEqual((stats['allowed'], stats['denied'], stats['errors']), (10, 10, 0))
+        self.assertEqual(stats['max_depth'], 20)
+        self.assertGreaterEqual(stats['latency_max'], 0.1)
+
+    async def test_02_coroutine_policy(self):
+        """ A coroutine policy can push config, or deny with reasons """
+        async def policy(event):
+            ''' Let in client 0 with a pushed route, deny the rest '''
+            if event.client_id == 0:
+                return AuthDecision(True, config=['push "route 10.0.0.0 255.0.0.0"'])
+            if event.client_id == 1:
+                raise RuntimeError('directory is down')
+            return AuthDecision(False, 'not on the "list"', 'go away')
+        handler = ClientAuthHandler(self.library, policy, workers=4)
+        await self.library.connect()
+        handler.start()
+        await self.wait_for_answers(handler, 20)
+        await handler.stop()
+        self.assertIn('client-auth 0 0', self.answers)
+        self.assertEqual(self.answers[self.answers.index('client-auth 0 0') + 1:][:2],
+                         ['push "route 10.0.0.0 255.0.0.0"', 'END'])
+        self.assertIn('client-deny 1 0 "client-auth policy failed"', self.answers)
+        self.assertIn('client-deny 2 0 "not on the \\"list\\"" "go away"', self.answers)
+        self.assertEqual(handler.errors, 1)
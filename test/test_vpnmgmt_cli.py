@@ -0,0 +1,101 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+   This tests the openvpn-mgmt command line tool
+"""
+import contextlib
+import io
+import json
+import threading
+import time
+import unittest
+import test.context  # pylint: disable=unused-import
+from test.fakeserver import FakeManagementServer
+from openvpn_management import main
+
+
+UNIX_SOCKET_FILENAME = '/tmp/good-test-path-cli'  # nosec hardcoded_tmp_directory
+
+
+class TestCommandLine(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.server = FakeManagementServer(UNIX_SOCKET_FILENAME, clients=50).start()
+
+    def tearDown(self):
+        """ Cleaning test rig """
+        self.server.stop()
+
+    def run_main(self, *argv):
+        """ Run the tool, returning its exit status and output rows """
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            status = main(['-s', UNIX_SOCKET_FILENAME] + list(argv))
+        return status, [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_01_status(self):
+        """ status gives a row for every client and route """
+        status, rows = self.run_main('status')
+        self.assertEqual(status, 0)
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(rows[0]['type'], 'client')
+        self.assertEqual(rows[0]['common_name'], 'user0@company.com')
+        self.assertEqual(rows[0]['bytes_sent'], 0)
+        self.assertEqual(rows[-1]['type'], 'route')
+
+    def test_02_users(self):
+        """ users gives the getusers table, a row each """
+        status, rows = self.run_main('users')
+        self.assertEqual(status, 0)
+        self.assertEqual(len(rows), 50)
+        self.assertEqual(rows[1], {'common_name': 'user1@company.com',
+                                   'real_address': '10.0.0.1:1025'})
+
+    def test_03_kill(self):
+        """ kill reports each user, and exits 1 when one wasn't there """
+        status, rows = self.run_main('kill', 'user1@company.com', '--commit')
+        self.assertEqual(status, 0)
+        self.assertTrue(rows[0]['success'])
+        self.assertNotIn(1, self.server.clients)
+        status, rows = self.run_main('kill', 'user1@company.com', 'user2@company.com', '--commit')
+        self.assertEqual(status, 1)
+        self.assertEqual([row['success'] for row in rows], [False, True])
+        status, rows = self.run_main('kill', 'user3@company.com')
+        self.assertEqual(status, 0)
+        self.assertFalse(rows[0]['commit'])
+        self.assertIn(3, self.server.clients)
+
+    def test_04_watch(self):
+        """ watch tails users coming and going until the server leaves """
+        result = {}
+
+        def watch():
+            ''' Run watch in the background '''
+            result['status'], result['rows'] = self.run_main('watch')
+        thread = threading.Thread(target=watch)
+        thread.start()
+        time.sleep(0.3)
+        cid = self.server.add_client('newcomer@company.com')
+        time.sleep(0.2)
+        self.server.remove_client(4)
+        time.sleep(0.3)
+        self.server.stop()
+        thread.join(5)
+        self.assertEqual(result['status'], 0)
+        self.assertEqual([(row['event'], row['common_name']) for row in result['rows']],
+                         [('connect', 'newcomer@company.com'),
+                          ('disconnect', 'user4@company.com')])
+        self.assertEqual(result['rows'][0]['real_address'],
+                         self.server.clients[cid].real_address)
+
+    def test_05_no_server(self):
+        """ An unreachable server is exit status 2, with nothing on stdout """
+        self.server.stop()
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            status, rows = self.run_main('users')
+        self.assertEqual(status, 2)
+        self.assertEqual(rows, [])
+        self.assertIn('cannot connect', err.getvalue())
@@ -16,7 +16,8 @@ import time
 import threading
 import socketserver
 import test.context  # pylint: disable=unused-import
-from openvpn_management import VPNmgmt
+from openvpn_management import VPNmgmt, PersistentVPNmgmt, VPNmgmtPool, ResponseReader, ManagementTimeout, \
+    FRAME_NONE, FRAME_LINE, FRAME_SUCCESS_END
 
 
 UNIX_SOCKET_FILENAME = '/tmp/good-test-path'  # nosec hardcoded_tmp_directory
@@ -60,6 +61,136 @@ class ServerErrors(socketserver.StreamRequestHandler):
         time.sleep(0.2)
 
 
+class ServerKills(socketserver.StreamRequestHandler):
+    '''
+        Simulate an openvpn management server socket which answers
+        every kill, one reply line per command line.
+    '''
+    def handle(self):
+        self.request.sendall(INITIAL_CONNECT + b'\r\n')
+        for line in self.rfile:
+            command = line.strip().decode('utf-8')
+            if command == 'quit':
+                break
+            user = command.split(' ', 1)[1]
+            if user.startswith('person'):
+                self.wfile.write(f"SUCCESS: common name '{user}' found, 1 client(s) killed\r\n".encode('utf-8'))
+            else:
+                self.wfile.write(f"ERROR: common name '{user}' not found\r\n".encode('utf-8'))
+
+
+class ServerNotifies(socketserver.StreamRequestHandler):
+    '''
+        Simulate an openvpn management server socket which mixes
+        real-time notifications in with its replies.
+    '''
+    def handle(self):
+        self.request.sendall(INITIAL_CONNECT + b'\r\n')
+        for line in self.rfile:
+            command = line.strip()
+            if command == b'quit':
+                break
+            if command == b'bytecount 5':
+                self.wfile.write(b'>BYTECOUNT_CLI:16,1,2\r\nSUCCESS: bytecount interval changed\r\n')
+            else:
+                self.wfile.write(b'TITLE,OpenVPN 2.4.6\r\n'
+                                 b'>CLIENT:DISCONNECT,16\r\n>CLIENT:ENV,common_name=person1@company.com\r\n'
+                                 b'ROUTING_TABLE,10.48.238.4,person2@company.com,1.2.3.4:49195,x,1537915504\r\n'
+                                 b'>CLIENT:ENV,END\r\nEND\r\n'
+                                 b'>BYTECOUNT_CLI:17,3,4\r\n')
+
+
+class ServerStalls(socketserver.StreamRequestHandler):
+    '''
+        Simulate an openvpn management server socket which takes a
+        command and then sits on it for far too long.
+    '''
+    def handle(self):
+        self.request.sendall(INITIAL_CONNECT + b'\r\n')
+        self.request.recv(1024)
+        time.sleep(1)
+
+
+class ServerHangsUp(socketserver.StreamRequestHandler):
+    '''
+        Simulate an openvpn management server socket which says yes to
+        everything, but hangs up after every 'pid'.
+    '''
+    def handle(self):
+        self.request.sendall(INITIAL_CONNECT + b'\r\n')
+        for line in self.rfile:
+            self.wfile.write(b'SUCCESS: ' + line.strip() + b'\r\n')
+            if line.strip() in (b'pid', b'quit'):
+                break
+
+
+class ServerTrickles(socketserver.StreamRequestHandler):
+    '''
+        Simulate an openvpn management server socket which answers a
+        command a byte at a time, and never gets to the end.
+    '''
+    def handle(self):
+        self.request.sendall(INITIAL_CONNECT + b'\r\n')
+        self.request.recv(1024)
+        try:
+            self.request.sendall(b'TITLE,OpenVPN 2.4.6\r\n')
+            while True:
+                self.request.sendall(b'C')
+                time.sleep(0.01)
+        except OSError:
+            pass
+
+
+class ServerPauses(socketserver.StreamRequestHandler):
+    '''
+        Simulate an openvpn management server socket which stops for a
+        while half way through every status, then finishes it, and says
+        yes to everything else.
+    '''
+    def handle(self):
+        self.request.sendall(INITIAL_CONNECT + b'\r\n')
+        try:
+            for line in self.rfile:
+                if line.startswith(b'status'):
+                    self.request.sendall(b'TITLE,OpenVPN 2.4.6\r\n'
+                                         b'ROUTING_TABLE,10.0.0.1,alice,1.2.3.4:5,x,1\r\n')
+                    time.sleep(0.5)
+                    self.request.sendall(b'ROUTING_TABLE,10.0.0.2,bob,1.2.3.5:5,x,1\r\nEND\r\n')
+                elif line.strip() == b'quit':
+                    break
+                else:
+                    self.request.sendall(b'SUCCESS: ' + line.strip() + b'\r\n')
+        except OSError:
+            pass
+
+
+class ServerWantsPassword(socketserver.StreamRequestHandler):
+    '''
+        Simulate a TCP openvpn management server socket with a password,
+        that dribbles out its prompt and banner in pieces, then says
+        yes to everything.
+    '''
+    def handle(self):
+        self.request.sendall(b'ENTER PASS')
+        time.sleep(0.05)
+        self.request.sendall(b'WORD:')
+        if self.rfile.readline().strip() != b'sekrit':
+            self.request.sendall(b'ERROR: bad password\r\n')
+            return
+        self.request.sendall(b'SUCCESS: password is correct\r\n' + INITIAL_CONNECT[:20])
+        time.sleep(0.05)
+        self.request.sendall(INITIAL_CONNECT[20:] + b'\r\n')
+        for line in self.rfile:
+            if line.strip() == b'quit':
+                break
+            self.wfile.write(b'SUCCESS: ' + line.strip() + b'\r\n')
+
+
+class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    ''' A local TCP stand-in for a 'management 127.0.0.1 PORT' server '''
+    daemon_threads = True
+
+
 class ThreadedStreamServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
     ''' Simple class name for the fake openvpn management server '''
     # No pass needed, per pylint
@@ -175,3 +306,272 @@ class TestVPNmgmtPrivate(unittest.TestCase):
         users = self.library.getusers()
         self.assertEqual(users, {},
                          'A confused server did not return an empty user list')
+
+    def test_20_kill_many(self):
+        """
+            A batch of kills big enough to fill the socket buffers both
+            ways comes back with one result per user, in order.
+        """
+        server = ThreadedStreamServer(UNIX_SOCKET_FILENAME, ServerKills)
+        server_thread = threading.Thread(target=server.serve_forever)
+        # Exit the server thread when the main thread terminates
+        server_thread.daemon = True
+        server_thread.start()
+        time.sleep(0.2)
+
+        self.library.connect()
+        users = [f'person{i}@company.com' if i % 3 else f'nobody{i}' for i in range(20000)]
+        results = self.library.kill_many(users, commit=True)
+        self.assertEqual(list(results), users)
+        for user in users:
+            self.assertEqual(results[user][0], user.startswith('person'))
+            self.assertIn(f"'{user}'", results[user][1])
+
+    def test_30_events(self):
+        """
+            Notifications that arrive in the middle of a reply go to the
+            event stream, not into the reply.
+        """
+        server = ThreadedStreamServer(UNIX_SOCKET_FILENAME, ServerNotifies)
+        server_thread = threading.Thread(target=server.serve_forever)
+        # Exit the server thread when the main thread terminates
+        server_thread.daemon = True
+        server_thread.start()
+        time.sleep(0.2)
+
+        self.library.connect()
+        seen = []
+        self.library.add_event_callback(seen.append)
+        replies = self.library.subscribe(bytecount=5)
+        self.assertTrue(replies['bytecount 5'].startswith('SUCCESS'))
+        self.assertEqual(self.library.subscriptions, ['bytecount 5'])
+        self.assertEqual(self.library.getusers(), {'person2@company.com': ('person2@company.com', '1.2.3.4:49195')})
+        events = self.library.poll_events(timeout=2)
+        if len(events) < 3:  # pragma: no cover
+            events += self.library.poll_events(timeout=2)
+        self.assertEqual([event.kind for event in events], ['BYTECOUNT_CLI', 'CLIENT:DISCONNECT', 'BYTECOUNT_CLI'])
+        self.assertEqual(events[1].env['common_name'], 'person1@company.com')
+        self.assertEqual(seen, events)
+
+    def test_40_pool(self):
+        """
+            A pool asks every server at once, and reports the ones that
+            are missing or too slow as errors rather than failing.
+        """
+        paths = [f'{UNIX_SOCKET_FILENAME}-pool{i}' for i in range(4)]
+        servers = []
+        for path, handler in zip(paths, [ServerKills, ServerKills, ServerStalls]):
+            if os.path.exists(path):  # pragma: no cover
+                os.unlink(path)
+            server = ThreadedStreamServer(path, handler)
+            server_thread = threading.Thread(target=server.serve_forever)
+            # Exit the server thread when the main thread terminates
+            server_thread.daemon = True
+            server_thread.start()
+            servers.append(server)
+        time.sleep(0.2)
+
+        pool = VPNmgmtPool(paths, timeout=0.5)
+        started = time.monotonic()
+        result = pool.kill('person1@company.com', commit=True)
+        self.assertLess(time.monotonic() - started, 0.9, 'servers were not asked concurrently')
+        self.assertEqual(sorted(result.results), paths[:2])
+        self.assertTrue(all(success for success, _reply in result.results.values()))
+        self.assertIsInstance(result.errors[paths[2]], socket.timeout)
+        self.assertIsInstance(result.errors[paths[3]], socket.error)
+        result = pool.kill_many(['person2@company.com', 'nobody'], commit=True)
+        self.assertEqual(result.merged()['nobody'][paths[0]][0], False)
+        self.assertEqual(sorted(result.merged()['person2@company.com']), paths[:2])
+        pool.disconnect()
+        for path in paths[:3]:
+            os.unlink(path)
+
+    def test_50_persistent(self):
+        """
+            A persistent connection notices the server hung up, and comes
+            back on a new connection with its subscriptions restored.
+        """
+        server = ThreadedStreamServer(UNIX_SOCKET_FILENAME, ServerHangsUp)
+        server_thread = threading.Thread(target=server.serve_forever)
+        # Exit the server thread when the main thread terminates
+        server_thread.daemon = True
+        server_thread.start()
+        time.sleep(0.2)
+
+        library = PersistentVPNmgmt(UNIX_SOCKET_FILENAME, keepalive_interval=0, backoff=0.01)
+        library.connect()
+        library.subscribe(bytecount=5)
+        self.assertTrue(library.keepalive())
+        time.sleep(0.1)
+        self.assertTrue(library.healthy())
+        self.assertEqual(library.reconnects, 1)
+        self.assertTrue(library.kill('person1@company.com', commit=True)[0],
+                        'the connection was not usable after reconnecting')
+        library.disconnect()
+
+    def test_51_persistent_gives_up(self):
+        """
+            Reconnecting stops after max_attempts, with the last error.
+        """
+        library = PersistentVPNmgmt(UNIX_SOCKET_FILENAME, backoff=0.01, max_attempts=3)
+        with self.assertRaises(socket.error):
+            library.connect()
+        self.assertFalse(library.healthy())
+        library.sock.close()
+
+    def test_60_deadline(self):
+        """
+            A reply that never ends is cut off at the deadline, with what
+            had arrived, and the connection left ready to reconnect.
+        """
+        server = ThreadedStreamServer(UNIX_SOCKET_FILENAME, ServerTrickles)
+        server_thread = threading.Thread(target=server.serve_forever)
+        # Exit the server thread when the main thread terminates
+        server_thread.daemon = True
+        server_thread.start()
+        time.sleep(0.2)
+
+        self.library.connect(timeout=1)
+        start = time.monotonic()
+        with self.assertRaises(ManagementTimeout) as caught:
+            self.library.status(timeout=0.3)
+        self.assertLess(time.monotonic() - start, 0.6, 'the deadline was not kept')
+        self.assertTrue(caught.exception.partial.startswith(b'TITLE,OpenVPN 2.4.6\r\nCC'))
+        self.library.connect(timeout=1)
+        with self.assertRaises(ManagementTimeout):
+            self.library.getusers(timeout=0.3)
+        self.library.connect(timeout=1)
+        with self.assertRaises(ManagementTimeout):
+            self.library.kill('person1@company.com', commit=False, timeout=0.3)
+        server.shutdown()
+
+    def test_61_connect_deadline(self):
+        """
+            A server that never says hello fails connect in time.
+        """
+        server = ThreadedStreamServer(UNIX_SOCKET_FILENAME, ServerConnects)
+        # Listening, but nobody will ever accept.
+        start = time.monotonic()
+        with self.assertRaises(ManagementTimeout):
+            self.library.connect(timeout=0.3)
+        self.assertLess(time.monotonic() - start, 0.6, 'the deadline was not kept')
+        server.server_close()
+
+    def test_62_quiet_mid_reply(self):
+        """
+            A server that goes quiet part way through a reply for longer
+            than read_timeout fails the command rather than passing off
+            half a reply, and the connection is reset, so the rest of
+            that reply can't be taken for the answer to the next command.
+        """
+        server = ThreadedStreamServer(UNIX_SOCKET_FILENAME, ServerPauses)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        time.sleep(0.2)
+
+        self.library.read_timeout = 0.2
+        self.library.connect(timeout=1)
+        with self.assertRaises(ManagementTimeout) as caught:
+            self.library.status()
+        self.assertIn(b'alice', caught.exception.partial)
+        self.library.connect(timeout=1)
+        self.assertEqual(self.library.kill('carol', commit=True), (True, 'SUCCESS: kill carol\r\n'))
+        with self.assertRaises(ManagementTimeout):
+            self.library.getusers()
+        self.library.connect(timeout=1)
+        self.assertEqual(self.library.kill('carol', commit=True), (True, 'SUCCESS: kill carol\r\n'))
+        server.shutdown()
+        server.server_close()
+
+    def test_70_tcp(self):
+        """
+            A TCP management interface is logged into with its password,
+            even with the prompt and banner coming in pieces.
+        """
+        server = ThreadedTCPServer(('127.0.0.1', 0), ServerWantsPassword)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        address = f'127.0.0.1:{server.server_address[1]}'
+
+        library = VPNmgmt(address, password='sekrit')
+        library.connect(timeout=2)
+        self.assertTrue(library.sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+        self.assertTrue(library.sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+        self.assertEqual(library._send('pid'), 'SUCCESS: pid\r\n',
+                         'the banner was not all cleared away')
+        library.disconnect()
+        for password in ('wrong', None):
+            library = VPNmgmt(address, password=password)
+            with self.assertRaises(PermissionError):
+                library.connect(timeout=2)
+            library.sock.close()
+        server.shutdown()
+        server.server_close()
+
+
+class TestResponseReader(unittest.TestCase):
+    """ Tests of the buffered reply reader, over a socketpair """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.server, client = socket.socketpair()
+        client.settimeout(0.0)
+        self.library = ResponseReader(client, chunk_size=512)
+
+    def tearDown(self):
+        """ Cleaning test rig """
+        self.server.close()
+        self.library.sock.close()
+
+    def test_01_large_reply(self):
+        """
+            A reply much larger than one read is returned whole, and
+            stops at the END line rather than a user named END.
+        """
+        lines = [f'CLIENT_LIST,user{i}@company.com,1.2.3.4:{i}' for i in range(2000)]
+        lines.insert(5, 'CLIENT_LIST,END,1.2.3.4:1')
+        payload = '\r\n'.join(lines + ['END', 'SUCCESS: pid=1']) + '\r\n'
+        sender = threading.Thread(target=self.server.sendall, args=(payload.encode('utf-8'),))
+        sender.start()
+        reply = self.library.read_reply()
+        sender.join()
+        self.assertEqual(reply.decode('utf-8'), '\r\n'.join(lines + ['END']) + '\r\n')
+        self.assertEqual(self.library.read_reply(FRAME_LINE), b'SUCCESS: pid=1\r\n',
+                         'the following reply was not left in the buffer')
+
+    def test_02_single_line(self):
+        """ A SUCCESS/ERROR line is a whole reply on its own """
+        self.server.sendall(b"ERROR: common name 'x' not found\r\n")
+        self.assertEqual(self.library.read_reply(), b"ERROR: common name 'x' not found\r\n")
+        self.server.sendall(b"SUCCESS: common name 'x' found, 1 client(s) killed\r\n")
+        self.assertEqual(self.library.read_reply(FRAME_LINE),
+                         b"SUCCESS: common name 'x' found, 1 client(s) killed\r\n")
+
+    def test_03_history_block(self):
+        """ 'log on all' style replies run past their SUCCESS line to END """
+        self.server.sendall(b'SUCCESS: real-time log notification set to ON\r\n'
+                            b'1537915507,I,Initialization Sequence Completed\r\nEND\r\n')
+        reply = self.library.read_reply(FRAME_SUCCESS_END)
+        self.assertTrue(reply.endswith(b'Completed\r\nEND\r\n'))
+        self.assertEqual(self.library.read_reply(FRAME_NONE), b'')
+
+    def test_04_stream_lines(self):
+        """
+            Lines are handed over as they arrive, and a caller that stops
+            early doesn't leave the rest of the reply behind.
+        """
+        self.server.sendall(b'TITLE,x\r\nCLIENT_LIST,a\r\nCLIENT_LIST,b\r\nEND\r\nSUCCESS: pid=1\r\n')
+        lines = self.library.iter_reply()
+        self.assertEqual(next(lines), b'TITLE,x')
+        self.assertEqual(next(lines), b'CLIENT_LIST,a')
+        lines.close()
+        self.assertEqual(self.library.read_reply(FRAME_LINE), b'SUCCESS: pid=1\r\n')
+
+    def test_05_closed(self):
+        """ A peer that closes mid-reply gets us what was sent so far """
+        self.server.sendall(b'TITLE,x\r\npartial')
+        self.server.close()
+        self.assertEqual(self.library.read_reply(), b'TITLE,x\r\npartial')
+        self.assertTrue(self.library.eof)
@@ -9,12 +9,16 @@
 """
    script testing script
 """
+import os
+import tempfile
+import threading
+import time
 import unittest
 import socket
 import textwrap
 import test.context  # pylint: disable=unused-import
 from unittest import mock
-from openvpn_management import VPNmgmt
+from openvpn_management import VPNmgmt, StatusCoalescer, StatusFileSource, UserPoller, LoadStats, StatusHistory, Event, Reconciler, LogEntry, StateEntry, parse_history, EventParser, Client, Route, Status, parse_status, reply_framing, FRAME_NONE, FRAME_LINE, FRAME_END, FRAME_SUCCESS_END
 
 
 UNIX_SOCKET_FILENAME = '/tmp/good-test-path'  # nosec hardcoded_tmp_directory
@@ -58,6 +62,20 @@ class TestVPNmgmtPublic(unittest.TestCase):
             testobj.connect()
         testobj.sock.close()
 
+    def test_03_addresses(self):
+        """
+            Verify that unix paths and TCP host:ports are told apart
+        """
+        library = VPNmgmt('127.0.0.1:7505')
+        self.assertEqual((library.family, library.address), (socket.AF_INET, ('127.0.0.1', 7505)))
+        library.sock.close()
+        library = VPNmgmt('[::1]:7505')
+        self.assertEqual((library.family, library.address), (socket.AF_INET6, ('::1', 7505)))
+        library.sock.close()
+        for address in ('127.0.0.1', '127.0.0.1:port', ':7505'):
+            with self.assertRaises(ValueError):
+                VPNmgmt(address)
+
     def test_10_status(self):
         """ Verify that status calls do the right thing """
         statusval = 'irrelevant'
@@ -65,9 +83,21 @@ class TestVPNmgmtPublic(unittest.TestCase):
         # This function is expected to be a passthrough
         with mock.patch.object(self.library, '_send', return_value=statusval) as mock_status:
             retval = self.library.status()
-        mock_status.assert_called_once_with('status 2', 'END')
+        mock_status.assert_called_once_with('status 2', None)
         self.assertEqual(retval, statusval)
 
+    def test_05_reply_framing(self):
+        """ Verify that each command's reply shape is known """
+        self.assertEqual(reply_framing('quit'), FRAME_NONE)
+        self.assertEqual(reply_framing('kill person1@company.com'), FRAME_LINE)
+        self.assertEqual(reply_framing('bytecount 5'), FRAME_LINE)
+        self.assertEqual(reply_framing('status 2'), FRAME_END)
+        self.assertEqual(reply_framing('version'), FRAME_END)
+        self.assertEqual(reply_framing('log 20'), FRAME_END)
+        self.assertEqual(reply_framing('state off'), FRAME_LINE)
+        self.assertEqual(reply_framing('state'), FRAME_END)
+        self.assertEqual(reply_framing('log on all'), FRAME_SUCCESS_END)
+
     def test_11_getuser_1(self):
         """
             Verify that we see the correct number of users on status1
@@ -88,12 +118,14 @@ class TestVPNmgmtPublic(unittest.TestCase):
             Max bcast/mcast queue length,0
             END
             ''')
-        with mock.patch.object(self.library, 'status', return_value=status_1):
+        with mock.patch.object(self.library, '_iter_reply', return_value=iter(status_1.splitlines())) as mock_status:
             users = self.library.getusers()
         self.assertIsInstance(users, dict,
                               'server version 1 did not return a user dict')
         self.assertEqual(len(users), 3,
                          'server version 1 did not find all users')
+        mock_status.assert_called_once_with('status 2', None)
+        self.assertEqual(users['person1@company.com'], ('person1@company.com', '9.10.11.12:40743'))
 
     def test_12_getuser_2(self):
         """
@@ -114,7 +146,7 @@ class TestVPNmgmtPublic(unittest.TestCase):
             GLOBAL_STATS,Max bcast/mcast queue length,0
             END
             ''')
-        with mock.patch.object(self.library, 'status', return_value=status_2):
+        with mock.patch.object(self.library, '_iter_reply', return_value=iter(status_2.splitlines())) as mock_status:
             users = self.library.getusers()
         self.assertIsInstance(users, dict,
                               'server version 2 did not return a user dict')
@@ -140,7 +172,7 @@ class TestVPNmgmtPublic(unittest.TestCase):
             GLOBAL_STATS	Max bcast/mcast queue length	0
             END
             ''')
-        with mock.patch.object(self.library, 'status', return_value=status_3):
+        with mock.patch.object(self.library, '_iter_reply', return_value=iter(status_3.splitlines())) as mock_status:
             users = self.library.getusers()
         self.assertIsInstance(users, dict,
                               'server version 3 did not return a user dict')
@@ -166,13 +198,164 @@ class TestVPNmgmtPublic(unittest.TestCase):
             GLOBAL_STATS,Max bcast/mcast queue length,0
             END
             ''')
-        with mock.patch.object(self.library, 'status', return_value=status_kiddie):
+        with mock.patch.object(self.library, '_iter_reply', return_value=iter(status_kiddie.splitlines())) as mock_status:
             users = self.library.getusers()
         self.assertIsInstance(users, dict,
                               'server version 2 did not return a user dict')
         self.assertEqual(len(users), 3,
                          'server version 2 did not find all users')
 
+    def test_15_parse_status(self):
+        """
+            Verify that status rows come out as typed records, in order,
+            and that anything else is skipped
+        """
+        status_2 = textwrap.dedent('''\
+            TITLE,OpenVPN 2.5.1 x86_64-pc-linux-gnu
+            HEADER,CLIENT_LIST,Common Name,Real Address,Virtual Address,Virtual IPv6 Address,Bytes Received,Bytes Sent,Connected Since,Connected Since (time_t),Username,Client ID,Peer ID,Data Channel Cipher
+            CLIENT_LIST,person1@company.com,[2001:db8::1]:40743,10.48.238.3,,1150910,9991285,Tue Sep 25 16:36:48 2018,1537893408,person1,16,0,AES-256-GCM
+            HEADER,ROUTING_TABLE,Virtual Address,Common Name,Real Address,Last Ref,Last Ref (time_t)
+            ROUTING_TABLE,10.48.238.3,person1@company.com,[2001:db8::1]:40743,Tue Sep 25 22:45:04 2018,1537915504
+            GLOBAL_STATS,Max bcast/mcast queue length,0
+            END
+            ''').encode('utf-8').splitlines(True)
+        records = list(parse_status(status_2))
+        self.assertEqual(len(records), 2)
+        self.assertIsInstance(records[0], Client)
+        self.assertEqual(records[0].real_address, '[2001:db8::1]:40743')
+        self.assertEqual(records[0].cipher, 'AES-256-GCM')
+        self.assertEqual(records[0].bytes_received, 1150910)
+        self.assertIsNone(records[0].virtual_ipv6_address)
+        self.assertIsInstance(records[1], Route)
+        self.assertEqual(records[1].common_name, 'person1@company.com')
+        self.assertEqual(list(parse_status(["ERROR: unknown command, enter 'help' for more options"])), [])
+
+    def test_16_parse_status_headers(self):
+        """
+            Verify that columns are found by their HEADER titles, so that
+            older and newer openvpn layouts both parse
+        """
+        # status 3 has tabs, beware if copying.
+        status_3 = textwrap.dedent('''\
+            TITLE	OpenVPN 2.3.10 x86_64-pc-linux-gnu
+            HEADER	CLIENT_LIST	Common Name	Real Address	Virtual Address	Bytes Received	Bytes Sent	Connected Since	Connected Since (time_t)	Username
+            CLIENT_LIST	person1@company.com	9.10.11.12:40743	10.48.238.3	1150910	9991285	Tue Sep 25 16:36:48 2018	1537893408	person1
+            HEADER	ROUTING_TABLE	Common Name	Virtual Address	Real Address	Last Ref	Last Ref (time_t)	Some Future Column
+            ROUTING_TABLE	person1@company.com	10.48.238.3	9.10.11.12:40743	Tue Sep 25 22:45:04 2018	1537915504	whatever
+            END
+            ''')
+        client, route = parse_status(status_3.splitlines())
+        self.assertEqual(client.virtual_address, '10.48.238.3')
+        self.assertIsNone(client.virtual_ipv6_address)
+        self.assertEqual(client.bytes_sent, 9991285)
+        self.assertEqual(client.username, 'person1')
+        self.assertIsNone(client.client_id)
+        self.assertEqual((route.common_name, route.virtual_address, route.last_ref_t),
+                         ('person1@company.com', '10.48.238.3', 1537915504))
+
+    def test_17_getstatus(self):
+        """
+            Verify that a status snapshot indexes both tables
+        """
+        status_2 = textwrap.dedent('''\
+            TITLE,OpenVPN 2.4.6 x86_64-redhat-linux-gnu
+            CLIENT_LIST,person1@company.com,9.10.11.12:40743,10.48.238.3,,1150910,9991285,Tue Sep 25 16:36:48 2018,1537893408,person1,16,0
+            CLIENT_LIST,person1@company.com,1.2.3.4:49195,10.48.238.4,,2181525,15443089,Tue Sep 25 16:55:46 2018,1537894546,person1,17,2
+            ROUTING_TABLE,10.48.238.4,person1@company.com,1.2.3.4:49195,Tue Sep 25 22:45:04 2018,1537915504
+            ROUTING_TABLE,10.48.238.3,person1@company.com,9.10.11.12:40743,Tue Sep 25 22:45:04 2018,1537915504
+            END
+            ''')
+        with mock.patch.object(self.library, '_iter_reply', return_value=iter(status_2.splitlines())):
+            status = self.library.getstatus()
+        self.assertIsInstance(status, Status)
+        self.assertEqual(len(status), 2)
+        self.assertEqual([client.client_id for client in status.by_common_name['person1@company.com']], [16, 17])
+        self.assertEqual(status.by_real_address['1.2.3.4:49195'].peer_id, 2)
+        self.assertEqual(status.by_virtual_address['10.48.238.3'].last_ref_t, 1537915504)
+        self.assertEqual(list(status.getusers()), ['person1@company.com'])
+        with self.assertRaises(AttributeError):
+            status.clients[0].nickname = 'compact records take no new attributes'
+
+    def test_18_event_parser(self):
+        """
+            Verify that notifications, including multi-line client
+            blocks, come out as Events
+        """
+        parser = EventParser()
+        self.assertIsNone(parser.feed(b'>CLIENT:ESTABLISHED,16'))
+        self.assertIsNone(parser.feed(b'>CLIENT:ENV,common_name=person1@company.com'))
+        self.assertIsNone(parser.feed(b'>CLIENT:ENV,trusted_ip=1.2.3.4'))
+        event = parser.feed(b'>CLIENT:ENV,END')
+        self.assertEqual(event.kind, 'CLIENT:ESTABLISHED')
+        self.assertEqual(event.client_id, 16)
+        self.assertEqual(event.env, {'common_name': 'person1@company.com', 'trusted_ip': '1.2.3.4'})
+        event = parser.feed('>BYTECOUNT_CLI:16,1150910,9991285\r\n')
+        self.assertEqual((event.kind, event.client_id, event.args), ('BYTECOUNT_CLI', 16, ['16', '1150910', '9991285']))
+        event = parser.feed(b'>LOG:1537915507,I,Peer Connection Initiated with [AF_INET]1.2.3.4:49195, yay')
+        self.assertEqual(event.args, ['1537915507', 'I', 'Peer Connection Initiated with [AF_INET]1.2.3.4:49195, yay'])
+        event = parser.feed(b">INFO:OpenVPN Management Interface Version 1 -- type 'help', for more info")
+        self.assertEqual(event.kind, 'INFO')
+        self.assertEqual(len(event.args), 1)
+
+    def test_19_getusers_changes(self):
+        """
+            Verify that the incremental user table starts from a status
+            and then follows client notifications
+        """
+        status_2 = textwrap.dedent('''\
+            TITLE,OpenVPN 2.4.6 x86_64-redhat-linux-gnu
+            CLIENT_LIST,person1@company.com,9.10.11.12:40743,10.48.238.3,,1150910,9991285,Tue Sep 25 16:36:48 2018,1537893408,person1,16,0
+            CLIENT_LIST,person2@company.com,1.2.3.4:49195,10.48.238.4,,2181525,15443089,Tue Sep 25 16:55:46 2018,1537894546,person2,17,2
+            ROUTING_TABLE,10.48.238.4,person2@company.com,1.2.3.4:49195,Tue Sep 25 22:45:04 2018,1537915504
+            ROUTING_TABLE,10.48.238.3,person1@company.com,9.10.11.12:40743,Tue Sep 25 22:45:04 2018,1537915504
+            END
+            ''')
+        self.library.track_users(resync_interval=None)
+        with mock.patch.object(self.library, '_iter_reply', return_value=iter(status_2.splitlines())) as mock_status, \
+                mock.patch.object(self.library.reader, 'read_notifications'):
+            users, added, removed = self.library.getusers_changes()
+            self.assertEqual(added, {'person1@company.com', 'person2@company.com'})
+            self.assertEqual(removed, set())
+            self.library._notification(b'>CLIENT:DISCONNECT,16')
+            self.library._notification(b'>CLIENT:ENV,END')
+            for line in (b'>CLIENT:ESTABLISHED,18', b'>CLIENT:ENV,common_name=person3@company.com',
+                         b'>CLIENT:ENV,trusted_ip=5.6.7.8', b'>CLIENT:ENV,trusted_port=33874', b'>CLIENT:ENV,END'):
+                self.library._notification(line)
+            users, added, removed = self.library.getusers_changes()
+        mock_status.assert_called_once_with('status 2', None)
+        self.assertEqual(added, {'person3@company.com'})
+        self.assertEqual(removed, {'person1@company.com'})
+        self.assertEqual(users['person3@company.com'], ('person3@company.com', '5.6.7.8:33874'))
+        self.assertEqual(sorted(users), ['person2@company.com', 'person3@company.com'])
+
+    def test_20_status_file(self):
+        """
+            Verify that a status file is parsed only when it changes,
+            and that a half-written one doesn't wipe out the last parse
+        """
+        status_2 = (
+            'TITLE,OpenVPN 2.4.6 x86_64-redhat-linux-gnu\n'
+            'ROUTING_TABLE,10.48.238.4,person2@company.com,1.2.3.4:49195,Tue Sep 25 22:45:04 2018,1537915504\n'
+            'ROUTING_TABLE,10.48.238.3,person1@company.com,9.10.11.12:40743,Tue Sep 25 22:45:04 2018,1537915504\n'
+            'GLOBAL_STATS,Max bcast/mcast queue length,0\n'
+            'END\n')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'openvpn-status.log')
+            with open(path, 'w') as handle:
+                handle.write(status_2)
+            source = StatusFileSource(path)
+            self.assertEqual(sorted(source.getusers()), ['person1@company.com', 'person2@company.com'])
+            self.assertEqual(len(source.getstatus().routes), 2)
+            self.assertEqual(source.parses, 1, 'an unchanged file was parsed again')
+            with open(path, 'w') as handle:
+                handle.write(status_2.split('ROUTING_TABLE,10.48.238.3')[0])
+            self.assertEqual(len(source.getusers()), 2, 'a half-written file was believed')
+            with open(path, 'w') as handle:
+                handle.write(status_2.replace('person2', 'person3'))
+            os.utime(path, ns=(1, 1))
+            self.assertEqual(sorted(source.getusers()), ['person1@company.com', 'person3@company.com'])
+            self.assertEqual(source.parses, 2)
+
     def test_21_kill_good_noop(self):
         """
             Verify that a fake disconnection returns true
@@ -180,7 +363,7 @@ class TestVPNmgmtPublic(unittest.TestCase):
         good_kill = "SUCCESS: common name 'person1@company.com' found, 1 client(s) killed"
         with mock.patch.object(self.library, '_send', return_value=good_kill) as mock_kill:
             killtest = self.library.kill('person1@company.com', commit=False)
-        mock_kill.assert_called_once_with('version')
+        mock_kill.assert_called_once_with('version', None)
         self.assertIsInstance(killtest, tuple,
                               'kill must return a list')
         self.assertEqual(len(killtest), 2,
@@ -199,7 +382,7 @@ class TestVPNmgmtPublic(unittest.TestCase):
         good_kill = "SUCCESS: common name 'person1@company.com' found, 1 client(s) killed"
         with mock.patch.object(self.library, '_send', return_value=good_kill) as mock_kill:
             killtest = self.library.kill('person1@company.com', commit=True)
-        mock_kill.assert_called_once_with('kill person1@company.com', stopon='\r\n')
+        mock_kill.assert_called_once_with('kill person1@company.com', None)
         self.assertIsInstance(killtest, tuple,
                               'kill must return a list')
         self.assertEqual(len(killtest), 2,
@@ -218,7 +401,7 @@ class TestVPNmgmtPublic(unittest.TestCase):
         bad_kill = "ERROR: common name 'sadf' not found"
         with mock.patch.object(self.library, '_send', return_value=bad_kill) as mock_kill:
             killtest = self.library.kill('sadf', commit=True)
-        mock_kill.assert_called_once_with('kill sadf', stopon='\r\n')
+        mock_kill.assert_called_once_with('kill sadf', None)
         self.assertIsInstance(killtest, tuple,
                               'kill must return a list')
         self.assertEqual(len(killtest), 2,
@@ -229,3 +412,184 @@ class TestVPNmgmtPublic(unittest.TestCase):
                               'kill return element 1 must be a string')
         self.assertFalse(killtest[0],
                          'a bad kill returns False')
+
+    def test_24_kill_many(self):
+        """
+            Verify that a batch kill sends every kill at once and maps
+            the replies back to users
+        """
+        replies = ["SUCCESS: common name 'person1@company.com' found, 1 client(s) killed",
+                   "ERROR: common name 'sadf' not found"]
+        with mock.patch.object(self.library, '_send_many', return_value=replies) as mock_kill:
+            killtest = self.library.kill_many(['person1@company.com', 'sadf', 'sadf'], commit=True)
+        mock_kill.assert_called_once_with(['kill person1@company.com', 'kill sadf'], None)
+        self.assertEqual(killtest, {'person1@company.com': (True, replies[0]),
+                                    'sadf': (False, replies[1])})
+
+    def test_25_kill_many_noop(self):
+        """
+            Verify that a fake batch kill only sends one version
+        """
+        with mock.patch.object(self.library, '_send', return_value='OpenVPN Version\r\nEND\r\n') as mock_kill:
+            killtest = self.library.kill_many(['person1@company.com', 'person2@company.com'])
+        mock_kill.assert_called_once_with('version', None)
+        self.assertEqual(sorted(killtest), ['person1@company.com', 'person2@company.com'])
+        self.assertEqual(self.library.kill_many([]), {})
+
+    def test_26_coalesce(self):
+        """
+            Verify that concurrent status callers share one fetch, and
+            that max_age serves from cache
+        """
+        def slow_status():
+            time.sleep(0.2)
+            return Status()
+        with mock.patch.object(self.library, 'getstatus', side_effect=slow_status) as mock_status:
+            coalescer = StatusCoalescer(self.library, max_age=60)
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(coalescer.getusers())) for _count in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(results, [{}] * 10)
+            coalescer.getstatus()
+        self.assertEqual(mock_status.call_count, 1)
+        self.assertEqual(coalescer.stats(), {'fetches': 1, 'coalesced': 9, 'hits': 1})
+
+    def test_27_coalesce_error(self):
+        """
+            Verify that a failed fetch raises, and isn't cached
+        """
+        coalescer = StatusCoalescer(self.library, max_age=60)
+        with mock.patch.object(self.library, 'status', side_effect=socket.timeout('slow')):
+            with self.assertRaises(socket.timeout):
+                coalescer.status()
+        with mock.patch.object(self.library, 'status', return_value='END'):
+            self.assertEqual(coalescer.status(), 'END')
+        self.assertEqual(coalescer.fetches, 2)
+
+    def test_28_load_stats(self):
+        """
+            Verify that load-stats comes back typed
+        """
+        reply = 'SUCCESS: nclients=2,bytesin=7613548,bytesout=3298113\r\n'
+        with mock.patch.object(self.library, '_send', return_value=reply) as mock_send:
+            stats = self.library.load_stats()
+        mock_send.assert_called_once_with('load-stats', None)
+        self.assertEqual(stats, LoadStats(2, 7613548, 3298113))
+        self.assertEqual(stats.nclients, 2)
+        with mock.patch.object(self.library, '_send', return_value="ERROR: unknown command\r\n"):
+            self.assertIsNone(self.library.load_stats())
+
+    def test_29_user_poller(self):
+        """
+            Verify that the poller only fetches users when the count moves
+        """
+        users = {'person1@company.com': ('person1@company.com', '1.2.3.4:1')}
+        counts = [LoadStats(1, 10, 10), LoadStats(1, 20, 20), LoadStats(2, 30, 30), None]
+        with mock.patch.object(self.library, 'load_stats', side_effect=counts), \
+                mock.patch.object(self.library, 'getusers', return_value=users) as mock_users:
+            poller = UserPoller(self.library, max_staleness=60)
+            self.assertEqual(poller.poll(), (users, True))
+            self.assertEqual(poller.poll(), (users, False))
+            self.assertEqual(mock_users.call_count, 1, 'fetched with nothing changed')
+            poller.poll()
+            poller.getusers()
+        self.assertEqual((poller.polls, poller.fetches), (4, 3))
+
+    def test_30_status_history(self):
+        """
+            Verify that status history gives rates and rankings
+        """
+        def snapshot(*clients):
+            ''' A Status of (cid, rx, tx, connected time_t) clients '''
+            return Status([Client(f'person{cid}@company.com', f'1.2.3.4:{cid}', client_id=cid,
+                                  bytes_received=rx, bytes_sent=tx, connected_since_t=since)
+                           for cid, rx, tx, since in clients])
+        history = StatusHistory(samples=3)
+        history.add_status(snapshot((1, 0, 0, 300), (2, 0, 0, 100), (3, 0, 0, 200)), when=0)
+        history.add_status(snapshot((1, 100, 1000, 300), (2, 50, 50, 100), (3, 10, 0, 200)), when=10)
+        top = history.top(2)
+        self.assertEqual([(rate.client_id, rate.rx_rate, rate.tx_rate) for rate in top],
+                         [(1, 10.0, 100.0), (2, 5.0, 5.0)])
+        self.assertEqual(history.top(1, by='rx')[0].common_name, 'person1@company.com')
+        self.assertEqual([rate.client_id for rate in history.longest_connected(2)], [2, 3])
+        # Client 2 leaves, and the ring of 3 wraps around for the others.
+        history.add_status(snapshot((1, 200, 1000, 300), (3, 20, 0, 200)), when=20)
+        history.add_status(snapshot((1, 1200, 1000, 300), (3, 30, 0, 200)), when=30)
+        self.assertEqual(len(history), 2)
+        rates = {rate.client_id: rate for rate in history.rates()}
+        self.assertEqual((rates[1].rx_rate, rates[1].tx_rate), (55.0, 0.0))
+        self.assertEqual(history.rates(window=10)[0].rx_rate, 100.0)
+        # bytecount notifications feed it too.
+        history.add_event(Event('BYTECOUNT_CLI', ['3', '2030', '0']), when=40)
+        self.assertEqual(history.top(1)[0].client_id, 3)
+        history.add_event(Event('CLIENT:DISCONNECT', ['3']))
+        self.assertEqual(len(history), 1)
+
+    def test_31_reconcile(self):
+        """
+            Verify that reconciling kills the right users, paced, capped
+        """
+        users = {f'person{i}@company.com': (f'person{i}@company.com', f'1.2.3.{i}:1194')
+                 for i in range(6)}
+        allow = [f'person{i}@company.com' for i in range(4)]
+
+        def kill_many(targets, commit=False):
+            ''' person5 has already gone '''
+            return {target: (commit and target != 'person5@company.com', 'reply') for target in targets}
+        with mock.patch.object(self.library, 'getusers', return_value=users), \
+                mock.patch.object(self.library, 'kill_many', side_effect=kill_many) as mock_kill:
+            reconciler = Reconciler(self.library, allow=allow, deny=['1.2.3.0:1194'],
+                                    rate=50, concurrency=1)
+            report = reconciler.run(commit=True)
+            self.assertEqual(sorted(report.violators), ['1.2.3.0:1194', 'person4@company.com',
+                                                        'person5@company.com'])
+            self.assertEqual(report.killed, ['1.2.3.0:1194', 'person4@company.com'])
+            self.assertEqual(report.failed, {'person5@company.com': 'reply'})
+            self.assertGreaterEqual(report.timings['kill'], 0.04, 'kills were not paced')
+            self.assertEqual(mock_kill.call_count, 3)
+
+            report = Reconciler(self.library, allow=allow, max_kills=1).run(commit=False)
+            self.assertEqual((report.killed, report.skipped),
+                             ([], ['person5@company.com', 'person4@company.com']))
+
+            lookups = []
+
+            def directory(name):
+                ''' A slow directory: only even-numbered people are staff '''
+                lookups.append(name)
+                return int(name[6]) % 2 == 0
+            reconciler = Reconciler(self.library, predicate=directory)
+            report = reconciler.run(commit=True)
+            self.assertEqual(report.killed, ['person1@company.com', 'person3@company.com'])
+            self.assertEqual(list(report.failed), ['person5@company.com'])
+            reconciler.run(commit=True)
+            self.assertEqual(len(lookups), 6, 'the directory answers were not cached')
+        with self.assertRaises(ValueError):
+            Reconciler(self.library)
+
+    def test_32_log_history(self):
+        """
+            Verify that log history is parsed as it is read, and that a
+            time cutoff stops the reading
+        """
+        lines = iter([b'1537915507,I,Initialization Sequence Completed',
+                      b'1537915600,W,WARNING: this, that',
+                      b'1537915700,I,later',
+                      b'1537915800,I,later still',
+                      b'END'])
+        with mock.patch.object(self.library, '_iter_reply', return_value=lines) as mock_reply:
+            entries = list(self.library.log(since=1537915600, until=1537915700))
+        mock_reply.assert_called_once_with('log all', None)
+        self.assertEqual(entries, [LogEntry(1537915600, 'W', 'WARNING: this, that'),
+                                   LogEntry(1537915700, 'I', 'later')])
+        self.assertEqual(next(lines), b'END', 'read on past the cutoff')
+        with mock.patch.object(self.library, '_iter_reply', return_value=iter([])) as mock_reply:
+            self.assertEqual(list(self.library.state(count=5)), [])
+        mock_reply.assert_called_once_with('state 5', None)
+        state = parse_history(['1537893169,CONNECTED,SUCCESS,10.8.0.1,198.51.100.1,1194,,\r\n'],
+                              StateEntry)
+        self.assertEqual(list(state), [StateEntry(1537893169, 'CONNECTED', 'SUCCESS', '10.8.0.1',
+                                                  '198.51.100.1', 1194)])
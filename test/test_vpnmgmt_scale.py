@@ -0,0 +1,113 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+   This tests the client against the simulated management server at size
+"""
+import time
+import unittest
+import test.context  # pylint: disable=unused-import
+from test.fakeserver import FakeManagementServer
+from openvpn_management import VPNmgmt, PersistentVPNmgmt, Metrics
+
+
+UNIX_SOCKET_FILENAME = '/tmp/good-test-path-scale'  # nosec hardcoded_tmp_directory
+
+
+class TestVPNmgmtScale(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.server = FakeManagementServer(UNIX_SOCKET_FILENAME, clients=20000).start()
+        self.library = VPNmgmt(UNIX_SOCKET_FILENAME)
+
+    def tearDown(self):
+        """ Cleaning test rig """
+        self.library.disconnect()
+        self.server.stop()
+
+    def test_01_status_versions(self):
+        """ Every status format gives every client, even delivered in dribs """
+        self.server.chunk_size = 4093
+        self.library.connect()
+        for version in (1, 2, 3):
+            records = list(self.library.iter_status(version))
+            self.assertEqual(len(records), 40000, f'status {version} lost rows')
+        users = self.library.getusers()
+        self.assertEqual(len(users), 20000)
+        self.assertEqual(users['user7@company.com'], ('user7@company.com', '10.0.0.7:1031'))
+
+    def test_02_kill_notifies(self):
+        """ A kill takes the client away and tells us it disconnected """
+        self.library.connect()
+        results = self.library.kill_many(['user1@company.com', 'user2@company.com', 'nobody'], commit=True)
+        self.assertEqual([result[0] for result in results.values()], [True, True, False])
+        self.assertEqual(len(self.server.clients), 19998)
+        events = self.library.poll_events(timeout=1)
+        self.assertEqual([event.kind for event in events if event.kind.startswith('CLIENT')],
+                         ['CLIENT:DISCONNECT', 'CLIENT:DISCONNECT'])
+
+    def test_03_tracked_users(self):
+        """ The incremental user table follows clients coming and going """
+        self.library.connect()
+        self.library.track_users(resync_interval=None)
+        users, added, _removed = self.library.getusers_changes()
+        self.assertEqual(len(added), 20000)
+        cid = self.server.add_client('newbie@company.com')
+        self.server.remove_client(5)
+        time.sleep(0.1)
+        users, added, removed = self.library.getusers_changes()
+        self.assertEqual((added, removed), ({'newbie@company.com'}, {'user5@company.com'}))
+        self.assertEqual(users['newbie@company.com'][1], self.server.clients[cid].real_address)
+
+    def test_04_unreliable_server(self):
+        """ A persistent client rides out a server that keeps hanging up """
+        self.server.disconnect_after = 2
+        self.server.latency = 0.001
+        library = PersistentVPNmgmt(UNIX_SOCKET_FILENAME, backoff=0.01)
+        library.connect()
+        for _count in range(5):
+            self.assertEqual(len(library.getusers()), 20000)
+        self.assertGreaterEqual(library.reconnects, 2)
+        library.disconnect()
+
+    def test_05_metrics(self):
+        """ With metrics on, every command is measured, by verb """
+        self.library.metrics = Metrics()
+        hooked = []
+        self.library.metrics.add_hook(lambda kind, name, fields: hooked.append((kind, name)))
+        self.library.connect()
+        self.library.getusers()
+        status = self.library.status()
+        self.library.kill_many(['user1@company.com', 'user2@company.com'], commit=True)
+        snapshot = self.library.metrics.snapshot()
+        stats = snapshot['commands']['status']
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(sum(stats['histogram']), 2)
+        self.assertGreaterEqual(stats['bytes_received'], 2 * len(status), 'replies went uncounted')
+        self.assertGreater(stats['recv_calls'], 2, 'a 20000 client status fits no single recv')
+        self.assertEqual(snapshot['commands']['kill']['commands'], 2)
+        self.assertEqual(snapshot['parses']['getusers']['calls'], 1)
+        self.assertEqual(hooked, [('command', 'status'), ('parse', 'getusers'),
+                                  ('command', 'status'), ('command', 'kill')])
+
+    def test_06_follow_log(self):
+        """ A long log is followed into a buffer that never outgrows its size """
+        self.server.log_history = [(1537893169 + count, 'I', f'line {count}')
+                                   for count in range(100000)]
+        self.library.connect()
+        self.assertEqual(sum(1 for _entry in self.library.log()), 100000)
+        window = list(self.library.log(since=1537893169 + 500, until=1537893169 + 509))
+        self.assertEqual([entry.message for entry in window], [f'line {count}' for count in range(500, 510)])
+        entries = self.library.follow_log(maxlen=50)
+        self.assertEqual(len(entries), 50)
+        self.assertEqual(entries[-1].message, 'line 99999')
+        for count in range(60):
+            self.server.log(f'live {count}')
+        while entries[-1].message != 'live 59':
+            self.library.poll_events(timeout=1)
+        self.assertEqual(len(entries), 50)
+        self.assertEqual(entries[0].message, 'live 10')
+        self.assertIn('log on', self.library.subscriptions)
+        self.assertTrue(self.library._send('pid').startswith('SUCCESS: pid='))
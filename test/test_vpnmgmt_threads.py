@@ -0,0 +1,79 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+   This tests sharing one client between threads
+"""
+import threading
+import time
+import unittest
+import test.context  # pylint: disable=unused-import
+from test.fakeserver import FakeManagementServer
+from openvpn_management import ThreadSafeVPNmgmt
+
+
+UNIX_SOCKET_FILENAME = '/tmp/good-test-path-threads'  # nosec hardcoded_tmp_directory
+
+
+class TestThreadSafeVPNmgmt(unittest.TestCase):
+    """ Class of tests """
+
+    def setUp(self):
+        """ Preparing test rig """
+        self.server = FakeManagementServer(UNIX_SOCKET_FILENAME, clients=1000).start()
+        self.library = ThreadSafeVPNmgmt(UNIX_SOCKET_FILENAME)
+        self.library.connect()
+
+    def tearDown(self):
+        """ Cleaning test rig """
+        self.library.disconnect()
+        self.server.stop()
+
+    def test_01_many_threads(self):
+        """ Threads hammering one client each get their own replies """
+        errors = []
+
+        def worker(number):
+            ''' Mix status dumps, kills and trivial commands '''
+            try:
+                for count in range(5):
+                    users = self.library.getusers()
+                    if not 900 <= len(users) <= 1000:
+                        errors.append(f'{len(users)} users')
+                    user = f'user{number * 5 + count}@company.com'
+                    success, reply = self.library.kill(user, commit=True)
+                    if not success or user not in reply:
+                        errors.append(reply)
+                    if not self.library._send('pid').startswith('SUCCESS: pid='):
+                        errors.append('pid')
+            except Exception as err:  # pylint: disable=broad-except
+                errors.append(repr(err))
+        threads = [threading.Thread(target=worker, args=(number,)) for number in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.library.getusers()), 900)
+
+    def test_02_kills_first(self):
+        """ A kill queued behind a status dump goes out ahead of it """
+        self.server.latency = 0.2
+        threads = [threading.Thread(target=self.library.status)]
+        threads[0].start()
+        time.sleep(0.1)
+        threads.append(threading.Thread(target=self.library.status))
+        threads[1].start()
+        time.sleep(0.05)
+        threads.append(threading.Thread(target=self.library.kill, args=('user1@company.com', True)))
+        threads[2].start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([command.split()[0] for command in self.server.commands],
+                         ['status', 'kill', 'status'])
+
+    def test_03_events(self):
+        """ Notifications keep coming while nobody is sending commands """
+        self.server.remove_client(3)
+        events = self.library.poll_events(timeout=1)
+        self.assertIn('CLIENT:DISCONNECT', [event.kind for event in events])